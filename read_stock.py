@@ -17,6 +17,7 @@ from pandas.io.data import DataReader
 import datetime
 import time
 import pdb
+import stock_helper
 
 def select_options(symbol_dic):
   """ Set a few options for the plots"""
@@ -56,19 +57,13 @@ def select_options(symbol_dic):
     options = 1
     """ Check the correctness of the entries"""
     if fieldValues[2] not in symbol_dic:
-      fieldValues[2] = fieldValues[2].lower()
-      idx = 0
-      for name in symbol_dic.values():
-        if fieldValues[2] in name:
-          question = eg.ynbox('are you talking about %s?' %(name))
-          if question == 1:
-            fieldValues[2] = symbol_dic.keys()[idx]
-            break
-          else:
-            idx += 1
-            continue
-        idx += 1
-      if idx == len(symbol_dic):
+      found = False
+      for symbol,name,match in stock_helper.load_symbol_index().search(fieldValues[2],limit=20):
+        if match == 'exact' or eg.ynbox('are you talking about %s?' %(name)) == 1:
+          fieldValues[2] = symbol
+          found = True
+          break
+      if not found:
         eg.msgbox('the company is not in the database or the symbol is incorrect')
         options = 0
         continue
@@ -79,15 +74,97 @@ def load_symbol_dic():
   """
   Load a dictionary of all tickers symbols in the NSYE, NASDAQ and AMEX stock
   markets. {keys - values}  ==  {symbol - company name}
+  (built from the cached loader of stock_helper)
   """
-  directory = '/home/gilles/projects/trading/quant_trading/symbols'
-  dic = {}
-  for item in os.listdir(directory):
-    with open(directory+'/'+item) as f:
-      for line in f:
-        if line.split(',')[0].replace('\"','') not in dic:
-          dic[line.split(',')[0].replace('\"','')] = line.split(',')[1].replace('\"','').lower()
-  return dic
+  return dict((symbol,info[0]) for symbol,info in stock_helper.load_symbol_dic().iteritems())
+
+MIN_PIXELS_PER_BAR = 4       # below this width, daily bars are merged into weekly or monthly bars
+BAR_WIDTHS = {'D':0.6,'W':4.,'M':20.}   # candle width in days for each bar level
+
+def _date_numbers(index):
+  """
+  matplotlib date numbers (days since 0001-01-01, plus one) of a DatetimeIndex, in one
+  vectorized pass instead of a date2num call per date
+  """
+  days = pd.DatetimeIndex(index).values.astype('datetime64[D]')
+  return (days-np.datetime64('0001-01-01','D')).astype(np.float64)+1
+
+def _bar_level(n_days,width):
+  """
+  'D' if n_days daily bars fit in width pixels, else 'W' (weekly bars) if they fit,
+  else 'M' (monthly bars)
+  """
+  capacity = width/float(MIN_PIXELS_PER_BAR)
+  if n_days <= capacity:
+    return 'D'
+  if n_days/5. <= capacity:
+    return 'W'
+  return 'M'
+
+class LevelOfDetailChart:
+  """
+  Candlesticks (ax_price) and volume bars (ax_volume) of a daily yahoo dataframe. The bars
+  are aggregated to weekly or monthly bars when the visible days do not fit in the width of
+  the axes, and only the visible range (plus one range on each side, for panning) is drawn.
+  Zooming or panning re-aggregates and redraws through the xlim_changed callback
+  """
+  def __init__(self,data,ax_price,ax_volume):
+    self._data = data
+    self._ax = ax_price
+    self._ax_volume = ax_volume
+    self._bars = {'D':(data,_date_numbers(data.index))}
+    self._artists = []
+    self._drawn = None          # (level, first date number, last date number) of the drawn bars
+    self._drawing = False
+    dates = self._bars['D'][1]
+    self.draw(dates[0],dates[-1])
+    ax_price.callbacks.connect('xlim_changed',self._on_xlim)
+
+  def _level_bars(self,level):
+    if level not in self._bars:
+      bars = stock_helper.resample_ohlcv(self._data,level)
+      self._bars[level] = (bars,_date_numbers(bars.index))
+    return self._bars[level]
+
+  def _level(self,first,last):
+    dates = self._bars['D'][1]
+    n_days = np.searchsorted(dates,last,side='right')-np.searchsorted(dates,first)
+    return _bar_level(n_days,self._ax.get_window_extent().width)
+
+  def draw(self,first,last):
+    """
+    Draw the bars between the date numbers first and last at the level fitting the axes
+    """
+    level = self._level(first,last)
+    bars,dates = self._level_bars(level)
+    span = last-first
+    lo = np.searchsorted(dates,first-span)
+    hi = np.searchsorted(dates,last+span,side='right')
+    if hi <= lo:
+      return
+    visible = bars.iloc[lo:hi]
+    quotes = np.column_stack((dates[lo:hi],visible['Open'].values,visible['Close'].values,
+                              visible['High'].values,visible['Low'].values))
+    self._drawing = True
+    try:
+      for artist in self._artists:
+        artist.remove()
+      lines,patches = candlestick(self._ax,quotes,width=BAR_WIDTHS[level])
+      volume = self._ax_volume.bar(dates[lo:hi],visible['Volume'].values,width=BAR_WIDTHS[level],align='center')
+    finally:
+      self._drawing = False
+    self._artists = list(lines)+list(patches)+list(volume)
+    self._drawn = (level,dates[lo],dates[hi-1])
+
+  def _on_xlim(self,ax):
+    if self._drawing:
+      return
+    first,last = ax.get_xlim()
+    level,drawn_first,drawn_last = self._drawn
+    if self._level(first,last) == level and first >= drawn_first and last <= drawn_last:
+      return
+    self.draw(first,last)
+    ax.figure.canvas.draw_idle()
 
 def plot_data(data,stock):
   ticks = eg.choicebox(msg = 'choose ticks for the plot',choices = ['day','week','month'])
@@ -103,22 +180,16 @@ def plot_data(data,stock):
 #  if candle_chart == 1:
   fig = plt.figure()
   ax1 = fig.add_subplot(211)
-  datelist = [matplotlib.dates.date2num(x) for x in data['Time']]
-  Prices = []
-  for idx in xrange(len(data)):
-    Prices.append((datelist[idx],data['Open'].ix[idx],data['Close'].ix[idx],data['High'].ix[idx],data['Low'].ix[idx]))
-#    candlestick(ax1,[datelist,data['Open'],data['Close'],data['High'],data['Low']])
-  candlestick(ax1,Prices)
   ax1.set_xlabel('Date')
   ax1.set_ylabel('$')
   ax1.set_title('Candlestick plot for %s' %stock)
-  ax2 = fig.add_subplot(212)
-  ax2.plot(datelist,data['Adj Close'],'-r',label = 'Adj. Close')
+  ax2 = fig.add_subplot(212,sharex=ax1)
+  ax2.plot(_date_numbers(data.index),data['Adj Close'].values,'-r',label = 'Adj. Close')
   ax2.set_ylabel('$')
   ax2.legend()
   ax3 = ax2.twinx()
-  ax3.bar(data['Time'],data['Volume'])
   ax3.set_ylabel('Shares')
+  fig.chart = LevelOfDetailChart(data,ax1,ax3)    # keep the callbacks alive with the figure
   ax1.xaxis_date()
   ax2.xaxis_date()
   ax3.xaxis_date()
@@ -127,10 +198,7 @@ def plot_data(data,stock):
 
 def Sharpe_ratio(data):
   """ Assuming 4% annual risk-free rate, and 252 trading days a year"""
-  daily_return=(data['Adj Close'][1:].as_matrix()-data['Adj Close'][:-1].as_matrix())/data['Adj Close'][:-1].as_matrix()
-  excess = daily_return - 0.04/252
-  Sharpe = np.sqrt(252)*np.mean(excess)/np.std(excess)
-  return Sharpe
+  return stock_helper.sharpe_ratio(data['Adj Close'].values,0.04,252)
 
 # -----------------------------------------------------------------------#
 stock_dic = load_symbol_dic()
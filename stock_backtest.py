@@ -0,0 +1,216 @@
+import numpy as np
+import pandas as pd
+import stock_helper
+import stock_panel
+import stock_rolling
+
+"""
+Vectorized backtests of the bollinger band and mean-reversion signals.
+
+Prices are a date-aligned panel (dates x symbols, see stock_panel). The strategy goes long
+when the price closes below the bottom band, short above the top band, and back to flat
+when the price crosses the moving average. These events are forward-filled into
+positions, without any loop over the dates. The positions are held from the next day.
+
+sweep evaluates a whole grid of (N_period, K_sigma) over all the symbols at once. The
+moving averages and standard deviations of one N_period are computed for every symbol
+in a single vectorized pass (stock_rolling.rolling_mean_std), and the z-scores of one
+N_period are shared by all the K_sigma. half_life_backtest
+uses the mean reversion half-life of each symbol as its look-back period. Each parameter
+set gets its Sharpe ratio, maximum drawdown and turnover per symbol.
+
+Usage: python stock_backtest.py AAPL MSFT ... --start 01/01/2010 --windows 10,20,50 --sigmas 1,1.5,2
+"""
+
+def _ffill(values):
+  """
+  Forward-fill the NaN of each column of a 2-D array (leading NaN are kept)
+  """
+  valid = ~np.isnan(values)
+  index = np.where(valid,np.arange(len(values))[:,np.newaxis],0)
+  np.maximum.accumulate(index,axis=0,out=index)
+  return values[index,np.arange(values.shape[1])]
+
+def _as_panel(prices):
+  """
+  2-D float array and column names of a dataframe panel, a 2-D array or a single series
+  """
+  if isinstance(prices,pd.DataFrame):
+    return prices.values.astype(np.float64),list(prices.columns)
+  if isinstance(prices,pd.Series):
+    return prices.values.astype(np.float64)[:,np.newaxis],[prices.name]
+  values = np.asarray(prices,dtype=np.float64)
+  if values.ndim == 1:
+    values = values[:,np.newaxis]
+  return values,range(values.shape[1])
+
+class PanelStats:
+  """
+  Rolling statistics of a price panel, for any window length. Gaps inside the history
+  of a symbol are forward-filled. A window reaching back before the first price of a
+  symbol gives NaN
+  """
+  def __init__(self,prices):
+    self.prices = _ffill(np.asarray(prices,dtype=np.float64))
+
+  def mean_std(self,window,ddof=1):
+    """
+    Rolling mean and standard deviation over window of every column, aligned on the
+    prices (see stock_rolling.rolling_mean_std)
+    """
+    return stock_rolling.rolling_mean_std(self.prices,window,ddof)
+
+  def zscore(self,window):
+    """
+    Distance of the prices to their moving average over window, in standard deviations
+    """
+    mean,std = self.mean_std(window)
+    with np.errstate(invalid='ignore',divide='ignore'):
+      return (self.prices-mean)/std
+
+  def returns(self):
+    """
+    Daily returns of every column (NaN before the first price)
+    """
+    return stock_helper.daily_returns(self.prices)
+
+def band_positions(z,K_sigma):
+  """
+  Positions (1 long, -1 short, 0 flat) from z-scores: enter long when z < -K_sigma,
+  short when z > K_sigma, exit when z crosses 0. Flat before the first event
+  """
+  events = np.empty(z.shape)
+  events.fill(np.nan)
+  sign = np.sign(z)
+  with np.errstate(invalid='ignore'):
+    events[1:][sign[1:]*sign[:-1] <= 0] = 0
+    events[z < -K_sigma] = 1
+    events[z > K_sigma] = -1
+  return np.nan_to_num(_ffill(events))
+
+def strategy_returns(returns,positions,cost=0.):
+  """
+  Daily returns of holding positions decided at each close until the next close, minus
+  cost (fraction of the position value) per unit of position traded.
+  Returns (strategy returns, position changes), NaN where the asset has no return
+  """
+  traded = np.abs(np.diff(np.vstack((np.zeros((1,positions.shape[1])),positions)),axis=0))
+  pnl = positions[:-1]*returns-cost*traded[:-1]
+  pnl[np.isnan(returns)] = np.nan
+  return pnl,traded
+
+def performance(pnl,traded,risk_free=0.,periods=252):
+  """
+  Annualized Sharpe ratio, maximum drawdown (negative fraction of the peak equity),
+  annualized turnover (position changes per year) and total return of each column
+  """
+  equity = np.cumprod(1+np.nan_to_num(pnl),axis=0)
+  drawdown = (equity/np.maximum.accumulate(equity,axis=0)-1).min(axis=0)
+  return {'Sharpe':stock_helper.returns_sharpe(pnl,risk_free,periods),
+          'max_drawdown':drawdown,
+          'turnover':traded.sum(axis=0)*periods/float(len(traded)),
+          'total_return':equity[-1]-1}
+
+RESULT_COLUMNS = ['N_period','K_sigma','symbol','Sharpe','max_drawdown','turnover','total_return']
+
+def _evaluate(stats,z,windows,symbols,sigmas,cost,risk_free,periods):
+  """
+  Results of the band strategy for each K_sigma, from the z-scores of every symbol
+  """
+  returns = stats.returns()
+  frames = []
+  for K_sigma in sigmas:
+    pnl,traded = strategy_returns(returns,band_positions(z,K_sigma),cost)
+    frame = pd.DataFrame(performance(pnl,traded,risk_free,periods))
+    frame['N_period'] = windows
+    frame['K_sigma'] = K_sigma
+    frame['symbol'] = symbols
+    frames.append(frame)
+  return frames
+
+def sweep(prices,windows,sigmas,cost=0.,risk_free=0.,periods=252):
+  """
+  Backtest the bollinger band strategy for every (N_period, K_sigma) of windows x sigmas
+  and every symbol of the prices panel.
+
+  Parameters:
+      - prices : dataframe panel (dates x symbols), 2-D array or single series
+      - windows : look-back periods N_period
+      - sigmas : band widths K_sigma, in standard deviations
+      - cost : trading cost per unit of position traded (e.g. 0.001 for 10 bps)
+      - risk_free, periods : annual risk-free rate and periods per year of the Sharpe ratio
+
+  Returns a dataframe with one row per (N_period, K_sigma, symbol)
+  """
+  values,symbols = _as_panel(prices)
+  stats = PanelStats(values)
+  frames = []
+  for window in windows:
+    frames += _evaluate(stats,stats.zscore(window),window,symbols,sigmas,cost,risk_free,periods)
+  return pd.concat(frames,ignore_index=True)[RESULT_COLUMNS]
+
+def half_life_windows(prices,minimum=2,maximum=252):
+  """
+  Look-back period of each column: its mean reversion half-life (see
+  stock_helper.mean_reversion_half_life) rounded and clipped to [minimum, maximum].
+  0 for the columns which are not mean reverting (negative or undefined half-life)
+  """
+  values,symbols = _as_panel(prices)
+  windows = np.zeros(values.shape[1],dtype=int)
+  for j in xrange(values.shape[1]):
+    column = values[:,j]
+    column = column[~np.isnan(column)]
+    if len(column) < 3*minimum:
+      continue
+    half_life = stock_helper.mean_reversion_half_life(pd.DataFrame({'Adj Close':column}))
+    if np.isfinite(half_life) and half_life > 0:
+      windows[j] = int(np.clip(np.round(half_life),minimum,maximum))
+  return windows
+
+def half_life_backtest(prices,sigmas,train=None,cost=0.,risk_free=0.,periods=252):
+  """
+  Backtest the band strategy with the half-life of each symbol as its look-back period,
+  for every K_sigma of sigmas. The half-lives are estimated on the first train days
+  (default: the whole period, which looks ahead). Symbols which are not mean reverting
+  are left out. Returns a dataframe in the format of sweep
+  """
+  values,symbols = _as_panel(prices)
+  windows = half_life_windows(values[:train] if train else values)
+  stats = PanelStats(values)
+  z = np.empty(values.shape)
+  z.fill(np.nan)
+  for window in np.unique(windows[windows > 0]):
+    columns = windows == window
+    z[:,columns] = stats.zscore(window)[:,columns]
+  frames = _evaluate(stats,z,windows,symbols,sigmas,cost,risk_free,periods)
+  results = pd.concat(frames,ignore_index=True)[RESULT_COLUMNS]
+  return results[results['N_period'] > 0].reset_index(drop=True)
+
+def summarize(results):
+  """
+  Mean of the statistics over the symbols for each parameter set, best Sharpe first
+  """
+  summary = results.groupby(['N_period','K_sigma'])[['Sharpe','max_drawdown','turnover','total_return']].mean()
+  return summary.sort_values('Sharpe',ascending=False)
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description='bollinger band strategy backtests on the stored prices')
+  parser.add_argument('symbols',nargs='+')
+  parser.add_argument('--start',help='dd/mm/yyyy')
+  parser.add_argument('--end',help='dd/mm/yyyy')
+  parser.add_argument('--windows',default='10,20,50',help='comma separated N_period values')
+  parser.add_argument('--sigmas',default='1,1.5,2',help='comma separated K_sigma values')
+  parser.add_argument('--cost',type=float,default=0.)
+  parser.add_argument('--half-life',action='store_true',help='use the half-life of each symbol as N_period')
+  args = parser.parse_args()
+
+  start = stock_helper.check_date_format(args.start)[0] if args.start else None
+  end = stock_helper.check_date_format(args.end)[0] if args.end else None
+  panel = stock_panel.load_panel(args.symbols,start,end)
+  sigmas = [float(value) for value in args.sigmas.split(',')]
+  if args.half_life:
+    results = half_life_backtest(panel,sigmas,cost=args.cost)
+  else:
+    results = sweep(panel,[int(value) for value in args.windows.split(',')],sigmas,args.cost)
+  print summarize(results)
@@ -0,0 +1,268 @@
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import resource
+import datetime
+import platform
+import tempfile
+import numpy as np
+import pandas as pd
+import stock_helper
+import stock_database
+
+"""
+Reproducible benchmarks of the storage and analytics paths, without network access.
+
+A synthetic market.db is generated for a given number of symbols and trading days (random
+walk prices, week-ends and exchange holidays skipped, late listings and a few missing
+days per symbol), in the layout stock_database uses. Then update_data, extract_series,
+stock.get_historical, get_Sharpe, moving_avg/moving_std, get_hurst and cadf are timed.
+Results (best time, throughput, peak resident memory of each benchmark and its growth
+over the memory already in use) are saved as JSON and can be compared with a previous
+baseline.
+
+Usage: python stock_benchmark.py --sizes 10x250,100x2500 --out baseline.json [--compare old.json]
+"""
+
+HOLIDAYS = [(1,1),(7,4),(12,25)]       # (month, day) closures, on top of the week-ends
+# exchange csv files shipped with the repository, so that stock_class (which loads the
+# symbol files when it is imported) does not depend on the local symbols directory
+SYMBOL_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+def trading_days(n_days,start=datetime.date(2000,1,3)):
+  """
+  n_days business days from start, without the fixed holidays
+  """
+  days = []
+  day = start
+  while len(days) < n_days:
+    if day.weekday() < 5 and (day.month,day.day) not in HOLIDAYS:
+      days.append(day)
+    day += datetime.timedelta(1)
+  return pd.DatetimeIndex(days)
+
+class SyntheticStock:
+  """
+  Minimal stand-in for a stock object, with the attributes used by update_data
+  """
+  def __init__(self,symbol,historical):
+    self._symbol = symbol
+    self._historical = historical
+    self._start = historical.index[0] if len(historical) else None
+    self._end = historical.index[-1] if len(historical) else None
+
+def synthetic_history(dates,rng,missing=0.002):
+  """
+  Random walk OHLCV dataframe over dates, starting at a random listing date and with a
+  fraction missing of the days left out
+  """
+  listed = rng.randint(0,max(1,len(dates)//5))
+  dates = dates[listed:]
+  dates = dates[rng.rand(len(dates)) >= missing]
+  n = len(dates)
+  close = 20*np.exp(np.cumsum(rng.normal(0.0003,0.02,n)))
+  spread = close*rng.uniform(0.001,0.02,n)
+  data = pd.DataFrame({'Open':close+rng.uniform(-1,1,n)*spread,
+                       'High':close+spread,
+                       'Low':close-spread,
+                       'Close':close,
+                       'Volume':rng.randint(1000,10000000,n),
+                       'Adj Close':close*0.98},index=dates,
+                      columns=['Open','High','Low','Close','Volume','Adj Close'])
+  data.index.name = 'Date'
+  return data
+
+def generate_database(path,n_symbols,n_days,layout='per_symbol',seed=0,integer_dates=False):
+  """
+  Write a synthetic market.db at path and point stock_database to it.
+  Returns the list of symbols
+  """
+  if os.path.exists(path):
+    os.remove(path)
+  stock_database.configure(path)
+  stock_database.LAYOUT = layout
+  stock_database.INTEGER_DATES = integer_dates
+  rng = np.random.RandomState(seed)
+  dates = trading_days(n_days)
+  symbols = ['S%05d' %i for i in xrange(n_symbols)]
+  sectors = ['Technology','Finance','Health Care','Energy','Consumer Services']
+
+  with stock_database.transaction() as cur:
+    cur.execute('CREATE TABLE IF NOT EXISTS SUMMARY(Symbol TEXT PRIMARY KEY, Name TEXT, Type TEXT, Sector TEXT, Industry TEXT)')
+    for symbol in symbols:
+      sector = sectors[rng.randint(len(sectors))]
+      cur.execute('INSERT OR IGNORE INTO SUMMARY VALUES(?,?,?,?,?)',(symbol,'company %s' %symbol,'stock',sector,sector+' industry'))
+      stock_database.write_historical(cur,symbol,synthetic_history(dates,rng))
+  stock_database.data_changed(symbols)
+  return symbols
+
+def _status(field):
+  """
+  Value in kB of a field of /proc/self/status (Linux), None if not available
+  """
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith(field+':'):
+          return int(line.split()[1])
+  except (IOError,OSError):
+    pass
+  return None
+
+def reset_peak_memory():
+  """
+  Reset the peak resident memory of the process to its current value (Linux 4.0+), so
+  that peak_memory gives the peak of what runs next. Returns False if not supported
+  """
+  try:
+    with open('/proc/self/clear_refs','w') as f:
+      f.write('5')
+    return True
+  except (IOError,OSError):
+    return False
+
+def peak_memory():
+  """
+  Peak resident memory of the process in kB since the last reset_peak_memory, or since
+  the start of the process without /proc (Linux units of ru_maxrss)
+  """
+  peak = _status('VmHWM')
+  if peak is None:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak
+
+def current_memory():
+  """
+  Resident memory of the process in kB (the peak so far without /proc)
+  """
+  current = _status('VmRSS')
+  return current if current is not None else peak_memory()
+
+def _memory_used(before):
+  """
+  Peak resident memory since reset_peak_memory and its growth over before (kB)
+  """
+  peak = peak_memory()
+  return {'peak_rss_kb':peak,'rss_delta_kb':max(peak-before,0)}
+
+def measure(name,func,rows,repeat=3):
+  """
+  Best wall time of func over repeat runs, with throughput and the peak memory of these
+  runs (the peak of the process is reset first, the growth over the memory in use
+  before the runs is reported as rss_delta_kb)
+  """
+  gc.collect()
+  reset_peak_memory()
+  before = current_memory()
+  times = []
+  for i in xrange(repeat):
+    start = time.time()
+    func()
+    times.append(time.time()-start)
+  best = min(times)
+  result = {'name':name,'seconds':best,'rows':rows,'rows_per_s':rows/best if best > 0 else None}
+  result.update(_memory_used(before))
+  return result
+
+def run_size(n_symbols,n_days,layout='per_symbol',repeat=3,directory=None,integer_dates=False):
+  """
+  Generate a database of n_symbols x n_days and time every benchmarked path on it
+  """
+  directory = directory or tempfile.mkdtemp(prefix='stock_benchmark')
+  path = os.path.join(directory,'market.db')
+  reset_peak_memory()
+  before = current_memory()
+  start = time.time()
+  symbols = generate_database(path,n_symbols,n_days,layout,integer_dates=integer_dates)
+  results = [{'name':'generate_database','seconds':time.time()-start,'rows':n_symbols*n_days,
+              'rows_per_s':n_symbols*n_days/(time.time()-start)}]
+  results[0].update(_memory_used(before))
+
+  rng = np.random.RandomState(1)
+  dates = trading_days(n_days)
+  sample = synthetic_history(dates,rng,missing=0)
+  small = sample.iloc[:min(len(sample),250)]
+  counter = [0]
+  def fresh(data):
+    counter[0] += 1
+    return SyntheticStock('BENCH%d' %counter[0],data)
+
+  results.append(measure('update_data (row by row)',lambda: stock_database.update_data(fresh(small)),len(small),repeat))
+  results.append(measure('update_data_bulk',lambda: stock_database.update_data_bulk(fresh(sample)),len(sample),repeat))
+
+  symbol = symbols[0]
+  end = dates[-1].date()
+  month = end-datetime.timedelta(30)
+  results.append(measure('extract_series (full)',lambda: stock_database.extract_series(symbol),n_days,repeat))
+  results.append(measure('extract_series (1 month, arrays)',
+                         lambda: stock_database.extract_series(symbol,month,end,['Adj Close'],as_arrays=True),21,repeat))
+
+  stock_helper.SYMBOL_DIRECTORY = SYMBOL_DIRECTORY
+  import stock_class
+  stk = stock_class.stock(symbol,dates[0].date(),end,mode='disk',interactive=False)
+  results.append(measure('stock.get_historical (disk)',stk.get_historical,n_days,repeat))
+  frame = stk._historical
+  results.append(measure('get_Sharpe',stk.get_Sharpe,len(frame),repeat))
+  results.append(measure('moving_avg/moving_std',lambda: (stk.__dict__.pop('_rolling_cache',None),
+                         stk.moving_avg(20),stk.moving_std(20)),len(frame),repeat))
+  results.append(measure('get_hurst (lag 100)',lambda: stock_helper.get_hurst(frame,100),len(frame),repeat))
+  other = stock_class.stock(symbols[1],dates[0].date(),end,mode='disk',interactive=False)
+  pair = other.get_historical()
+  both = frame.index.intersection(pair.index)
+  results.append(measure('cadf',lambda: stock_helper.cadf(frame.loc[both],pair.loc[both]),len(both),repeat))
+
+  stock_database.manager().release()
+  shutil.rmtree(directory,ignore_errors=True)
+  for result in results:
+    result.update({'symbols':n_symbols,'days':n_days,'layout':layout})
+  return results
+
+def compare(results,baseline):
+  """
+  Print the time ratio of each benchmark against a previous baseline (> 1: slower)
+  """
+  previous = dict(((item['name'],item['symbols'],item['days'],item['layout']),item) for item in baseline['results'])
+  for item in results:
+    key = (item['name'],item['symbols'],item['days'],item['layout'])
+    if key in previous and previous[key]['seconds'] > 0:
+      print '%-36s %6dx%-6d %8.4fs  x%.2f' %(item['name'],item['symbols'],item['days'],
+            item['seconds'],item['seconds']/previous[key]['seconds'])
+
+def run(sizes,layout='per_symbol',repeat=3,out=None,baseline=None,integer_dates=False):
+  """
+  Run the benchmarks for each (symbols, days) size, save them to out and compare them
+  with the baseline file if given
+  """
+  results = []
+  for n_symbols,n_days in sizes:
+    for item in run_size(n_symbols,n_days,layout,repeat,integer_dates=integer_dates):
+      print '%-36s %6dx%-6d %8.4fs %12s rows/s %9d kB (+%d kB)' %(item['name'],n_symbols,n_days,item['seconds'],
+            '%.0f' %item['rows_per_s'] if item['rows_per_s'] else '-',item['peak_rss_kb'],item['rss_delta_kb'])
+      results.append(item)
+  report = {'meta':{'date':datetime.datetime.now().isoformat(),'python':platform.python_version(),
+                    'numpy':np.__version__,'pandas':pd.__version__,'layout':layout,'repeat':repeat,
+                    'integer_dates':integer_dates},
+            'results':results}
+  if out:
+    with open(out,'w') as f:
+      json.dump(report,f,indent=2)
+  if baseline:
+    with open(baseline) as f:
+      compare(results,json.load(f))
+  return report
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description='offline benchmarks of stock_database and the analytics')
+  parser.add_argument('--sizes',default='10x250,100x2500',help='comma separated SYMBOLSxDAYS sizes')
+  parser.add_argument('--layout',default='per_symbol',choices=['per_symbol','long'])
+  parser.add_argument('--repeat',type=int,default=3)
+  parser.add_argument('--integer-dates',action='store_true',help='store the dates as YYYYMMDD integers')
+  parser.add_argument('--out',help='save the results to this JSON file')
+  parser.add_argument('--compare',help='JSON baseline to compare with')
+  args = parser.parse_args()
+  sizes = [tuple(int(value) for value in size.split('x')) for size in args.sizes.split(',')]
+  run(sizes,args.layout,args.repeat,args.out,args.compare,args.integer_dates)
@@ -0,0 +1,158 @@
+import os
+import time
+import sqlite3
+import hashlib
+import cPickle
+import functools
+import numpy as np
+import pandas as pd
+import stock_helper
+import stock_database
+
+"""
+Persistent memoization of the stationarity tests of stock_helper.
+
+Results are stored in a sqlite sidecar next to market.db, keyed by the function, the
+symbol, the date range, the parameters and a hash of the content of the input series,
+so that re-running an analysis on unchanged data costs a lookup. The least recently used
+results are evicted once the cache grows over MAX_BYTES (checked every EVICT_EVERY
+stores), and the results of a symbol are dropped when stock_database writes new rows
+for it.
+
+Usage: stock_cache.ADF_test(series,1,symbol='AAPL') instead of stock_helper.ADF_test(series,1)
+"""
+
+CACHE_PATH = None             # default: analytics_cache.db next to the database
+MAX_BYTES = 256*1024*1024
+EVICT_EVERY = 100             # puts between two size checks (each check scans the table)
+ENABLED = True
+
+_MANAGERS = {}                # cache path - stock_database.ConnectionManager
+_MISSING = object()
+_PUTS = 0                     # results stored by this process
+
+def cache_path():
+  if CACHE_PATH is not None:
+    return CACHE_PATH
+  return os.path.join(os.path.dirname(stock_database.DB_PATH),'analytics_cache.db')
+
+def _connection():
+  """
+  Connection of the calling thread (and process) to the sidecar, with the same PRAGMAS
+  as the database. The table is created with the manager of the sidecar, on first use
+  """
+  path = cache_path()
+  if path not in _MANAGERS:
+    manager = stock_database.ConnectionManager(path,**stock_database.PRAGMAS)
+    db = manager.connect()
+    db.execute('CREATE TABLE IF NOT EXISTS CACHE(key TEXT PRIMARY KEY, symbol TEXT, function TEXT, value BLOB, size INTEGER, last_used REAL)')
+    db.execute('CREATE INDEX IF NOT EXISTS CACHE_symbol ON CACHE(symbol)')
+    db.execute('CREATE INDEX IF NOT EXISTS CACHE_last_used ON CACHE(last_used)')
+    db.commit()
+    db.close()
+    _MANAGERS[path] = manager
+  return _MANAGERS[path].get()
+
+def _digest(values,h):
+  values = np.asarray(values)
+  if values.dtype == object:
+    h.update(repr(values.tolist()))
+  else:
+    h.update(str(values.dtype))
+    h.update(np.ascontiguousarray(values).tostring())
+
+def _key(function,symbol,series,args,kwargs):
+  """
+  Cache key of a call: function, symbol, date range, parameters and content hash
+  """
+  h = hashlib.sha1()
+  if isinstance(series,(pd.DataFrame,pd.Series)):
+    _digest(series.index.values,h)
+    data = series['Adj Close'] if isinstance(series,pd.DataFrame) and 'Adj Close' in series.columns else series
+    _digest(data.values,h)
+    dates = (str(series.index[0]),str(series.index[-1])) if len(series) else ('','')
+  else:
+    _digest(series,h)
+    dates = ('','')
+  params = repr((args,sorted(kwargs.items())))
+  return hashlib.sha1('|'.join([function,str(symbol),dates[0],dates[1],params,h.hexdigest()])).hexdigest()
+
+def _get(key):
+  db = _connection()
+  row = db.execute('SELECT value FROM CACHE WHERE key=?',(key,)).fetchone()
+  if row is None:
+    return _MISSING
+  db.execute('UPDATE CACHE SET last_used=? WHERE key=?',(time.time(),key))
+  db.commit()
+  return cPickle.loads(str(row[0]))
+
+def _put(key,symbol,function,value):
+  global _PUTS
+  blob = cPickle.dumps(value,cPickle.HIGHEST_PROTOCOL)
+  db = _connection()
+  db.execute('INSERT OR REPLACE INTO CACHE VALUES(?,?,?,?,?,?)',
+             (key,symbol,function,sqlite3.Binary(blob),len(blob),time.time()))
+  _PUTS += 1
+  if _PUTS%EVICT_EVERY == 0:
+    evict(db)
+  db.commit()
+
+def evict(db=None,max_bytes=None):
+  """
+  Drop the least recently used results until the cache is below max_bytes
+  (default MAX_BYTES)
+  """
+  if db is None:
+    db = _connection()
+  if max_bytes is None:
+    max_bytes = MAX_BYTES
+  total = db.execute('SELECT COALESCE(SUM(size),0) FROM CACHE').fetchone()[0]
+  if total <= max_bytes:
+    return
+  stale = []
+  for key,size in db.execute('SELECT key,size FROM CACHE ORDER BY last_used').fetchall():
+    if total <= max_bytes:
+      break
+    stale.append((key,))
+    total -= size
+  db.executemany('DELETE FROM CACHE WHERE key=?',stale)
+  db.commit()
+
+def invalidate(symbol):
+  """
+  Drop the cached results of symbol (called by stock_database when new rows are written)
+  """
+  if not os.path.exists(cache_path()):
+    return
+  db = _connection()
+  db.execute('DELETE FROM CACHE WHERE symbol=?',(symbol,))
+  db.commit()
+
+def clear():
+  db = _connection()
+  db.execute('DELETE FROM CACHE')
+  db.commit()
+
+def memoize(func):
+  """
+  Persistent memoization of an analytic func(series,*params). The decorated function
+  takes an optional keyword argument symbol, which ties the cached results to the symbol
+  for invalidation
+  """
+  @functools.wraps(func)
+  def cached(series,*args,**kwargs):
+    symbol = kwargs.pop('symbol',None)
+    if not ENABLED:
+      return func(series,*args,**kwargs)
+    key = _key(func.__name__,symbol,series,args,kwargs)
+    value = _get(key)
+    if value is _MISSING:
+      value = func(series,*args,**kwargs)
+      _put(key,symbol,func.__name__,value)
+    return value
+  return cached
+
+ADF_test = memoize(stock_helper.ADF_test)
+variance_ratio_test = memoize(stock_helper.variance_ratio_test)
+mean_reversion_half_life = memoize(stock_helper.mean_reversion_half_life)
+get_hurst = memoize(stock_helper.get_hurst)
@@ -8,11 +8,14 @@ from pandas.io.data import DataReader
 import easygui as eg
 import stock_helper
 import stock_database
+import stock_rolling
+import stock_columnar
 import numpy as np
 import pdb
 import matplotlib.pyplot as plt
 
 SYMBOL_DIC = stock_helper.load_symbol_dic()
+SYMBOL_INDEX = stock_helper.load_symbol_index()
 
 class stock:
   """
@@ -43,6 +46,8 @@ class stock:
                  In "online" mode, the historical data from start date to end date is directly
                  downloaded from Yahoo Finance API.
                  In "disk" mode, the historical data is extracted from hard drive 
+                 In "columnar" mode, it is read from the memory-mapped columnar copy
+                 of the database (see stock_columnar)
 
         - symbol_dic : dictionary. At initialization, a dictionary {symbol - company name} will
                        be loaded. No need for modifications.
@@ -132,16 +137,21 @@ class stock:
     """
     If mode = "online", download Yahoo quotes from start to end date in a pandas dataframe
     If mode = "disk", the data is extracted from the hard drive
+    If mode = "columnar", the data is read from the memory-mapped columnar store
     """
     if self._mode == "online":
       self._historical = DataReader(self._symbol,'yahoo',self._start,self._end)
     else:
-      # check dictionary of symbols and open the file at the correct location
-      data = stock_database.extract_series(self._symbol)
-      df = pd.DataFrame(data,columns = ['date','Open','High','Low','Close','Volume','Adj Close'])
-      self._historical = df[pd.to_datetime(df['date']) > self._start]
-      self._historical = self._historical[pd.to_datetime(df['date']) < self._end]
-    self._historical = self._historical.set_index('date')
+      # only the rows between start and end are read from the database
+      columns = ['Open','High','Low','Close','Volume','Adj Close']
+      if self._mode == "columnar":
+        data = stock_columnar.load_symbol(self._symbol,self._start,self._end,columns)
+      else:
+        data = stock_database.extract_series(self._symbol,self._start,self._end,columns,as_arrays=True)
+      if data is None:
+        data = dict((col,[]) for col in ['date']+columns)
+      index = pd.DatetimeIndex(data.pop('date'),name='date')
+      self._historical = pd.DataFrame(data,index=index,columns=columns)
     return self._historical
 
 
@@ -164,17 +174,15 @@ class stock:
              initialization is not recommended, or it has to be exactly matching
              the name in the dictionary.
     """
-    idx = 0
-    for company_name in SYMBOL_DIC.values():
-      if self._name.lower() == company_name[0]:           # <-- check for exact match first
-        self._symbol = SYMBOL_DIC.keys()[idx]
+    for symbol,company_name,match in SYMBOL_INDEX.search(self._name,limit=20):
+      if match == 'exact':                                 # <-- exact matches are ranked first
+        self._symbol = symbol
         break
-      elif self._name.lower() in company_name[0] and self._interactive == True:  # <-- if partial match and interactive mode, ask the user
-        question = eg.ynbox('are you talking about %s?' %(company_name[0]))
+      elif self._interactive == True:   # <-- if partial match and interactive mode, ask the user
+        question = eg.ynbox('are you talking about %s?' %(company_name))
         if question == 1:
-          self._symbol = SYMBOL_DIC.keys()[idx]
+          self._symbol = symbol
           break
-      idx += 1
     if self._symbol == 'unknown':  # <-- after checking all entries of the dictionary
       print('The provided company name does not match any symbol')
       del self
@@ -182,35 +190,42 @@ class stock:
     return self._symbol
 
 
-  def get_Sharpe(self):
+  def get_Sharpe(self,risk_free=0.04,periods=252):
     """
     Calculate the Sharpe ratio for the perod between start and end dates
-    assuming 4% annual risk-free rate, and 252 trading days a year
+    assuming 4% annual risk-free rate, and 252 trading days a year by default
     """
-    daily_return=(self._historical['Adj Close'][1:].as_matrix()-self._historical['Adj Close'][:-1].as_matrix())/self._historical['Adj Close'][:-1].as_matrix()
-    excess = daily_return - 0.04/252
-    Sharpe = np.sqrt(252)*np.mean(excess)/np.std(excess)
-    return Sharpe
+    return stock_helper.sharpe_ratio(self._historical['Adj Close'].values,risk_free,periods)
 
   def moving_avg(self,window):
     """M
     Calculate the moving average of the adjusted close price of the stock
     window is the number of days for calculating the average
     """
-    try:
-      if not self._historical:
-        self.get_historical()
-    except:
-      pass
-    return pd.rolling_mean(self._historical['Adj Close'].iloc[window+1:],window)
+    return self._rolling(window)[0]
 
   def moving_std(self,window):
+    return self._rolling(window)[1]
+
+  def _rolling(self,window):
+    """
+    Moving average and standard deviation of the adjusted close price over window,
+    computed in one pass and shared by moving_avg, moving_std and bollinger_bands
+    (recomputed only when the historical data changes)
+    """
     try:
       if not self._historical:
         self.get_historical()
     except:
       pass
-    return pd.rolling_std(self._historical['Adj Close'].iloc[window+1:],window)
+    prices = self._historical['Adj Close'].iloc[window+1:]
+    cache = getattr(self,'_rolling_cache',{})
+    key = (window,id(self._historical),len(prices))
+    if key not in cache:
+      mean,std = stock_rolling.rolling_mean_std(prices.values,window)
+      cache[key] = (pd.Series(mean,index=prices.index),pd.Series(std,index=prices.index))
+      self._rolling_cache = cache
+    return cache[key]
 
   def bollinger_bands(self,N_period,K_sigma):
     """
@@ -228,4 +243,19 @@ class stock:
     top.plot(color='r')
     bottom.plot(color='b')
     plt.show()
-    return
\ No newline at end of file
+    return
+
+  def live_bollinger_bands(self,N_period,K_sigma):
+    """
+    Bollinger bands engine fitted on the historical adjusted close price. Call its
+    update(price) method with each new daily close to get the new
+    (moving average, top band, bottom band) in constant time
+    """
+    try:
+      if not self._historical:
+        self.get_historical()
+    except:
+      pass
+    bands = stock_rolling.BollingerBands(N_period,K_sigma)
+    bands.fit(self._historical['Adj Close'].values)
+    return bands
\ No newline at end of file
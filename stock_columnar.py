@@ -0,0 +1,112 @@
+import os
+import json
+import shutil
+import urllib
+import tempfile
+import numpy as np
+import stock_database
+
+"""
+Memory-mapped columnar copy of the historical data, for research jobs loading many symbols.
+
+Each symbol has a directory with one contiguous .npy file per column plus the sorted
+dates (datetime64[D]), opened with memory mapping: a date range is located by binary
+search on the dates and returned as views of the mapped files, so only the pages actually
+read are loaded. A manifest marks the copy as valid. stock_database removes it when new
+rows are written for the symbol, and the copy is rebuilt from market.db on the next load.
+"""
+
+COLUMNAR_DIR = None           # default: "columnar" directory next to the database
+COLUMNS = ['Open','High','Low','Close','Volume','Adj Close']
+MANIFEST = 'manifest.json'
+
+def root():
+  if COLUMNAR_DIR is not None:
+    return COLUMNAR_DIR
+  return os.path.join(os.path.dirname(stock_database.DB_PATH),'columnar')
+
+def symbol_dir(symbol):
+  return os.path.join(root(),urllib.quote(symbol,safe=''))
+
+def _column_file(column):
+  return column.replace(' ','_')+'.npy'
+
+def export_symbol(symbol):
+  """
+  (Re)build the columnar copy of symbol from the database. The files are written in a
+  temporary directory of its own which then replaces the current copy, so that several
+  processes can rebuild the same symbol (the last one to finish wins).
+  Returns False if the symbol is not in the database
+  """
+  data = stock_database.extract_series(symbol,columns=COLUMNS,as_arrays=True)
+  path = symbol_dir(symbol)
+  if data is None:
+    return False
+  try:
+    os.makedirs(root())
+  except OSError:
+    if not os.path.isdir(root()):
+      raise
+  tmp = tempfile.mkdtemp(prefix='.tmp-',dir=root())
+  os.chmod(tmp,0755)                 # mkdtemp creates it private to the user
+  np.save(os.path.join(tmp,'date.npy'),data['date'])
+  for column in COLUMNS:
+    np.save(os.path.join(tmp,_column_file(column)),data[column])
+  with open(os.path.join(tmp,MANIFEST),'w') as f:
+    json.dump({'rows':len(data['date']),'last':str(data['date'][-1]) if len(data['date']) else None},f)
+  # move the current copy out of the way, then rename the new one in its place. Another
+  # process may do the same in between: the copy it renamed is as recent, keep it
+  old = tempfile.mkdtemp(prefix='.old-',dir=root())
+  try:
+    os.rename(path,os.path.join(old,'copy'))
+  except OSError:
+    pass
+  try:
+    os.rename(tmp,path)
+  except OSError:
+    shutil.rmtree(tmp,ignore_errors=True)
+  shutil.rmtree(old,ignore_errors=True)
+  return True
+
+def invalidate(symbol):
+  """
+  Mark the columnar copy of symbol as stale (called by stock_database on new rows)
+  """
+  manifest = os.path.join(symbol_dir(symbol),MANIFEST)
+  if os.path.exists(manifest):
+    os.remove(manifest)
+
+def load_symbol(symbol,start=None,end=None,columns=None):
+  """
+  Memory-mapped columns of symbol between start and end (both included), in the format of
+  stock_database.extract_series(...,as_arrays=True): {column - array}, the arrays being
+  read-only views of the mapped files. Returns None if the symbol is not in the database
+  """
+  if columns is None:
+    columns = COLUMNS
+  path = symbol_dir(symbol)
+  if not os.path.exists(os.path.join(path,MANIFEST)):
+    if not export_symbol(symbol):
+      return None
+  dates = np.load(os.path.join(path,'date.npy'),mmap_mode='r')
+  first,last = 0,len(dates)
+  if start is not None:
+    first = np.searchsorted(dates,np.datetime64(start,'D'))
+  if end is not None:
+    last = np.searchsorted(dates,np.datetime64(end,'D'),side='right')
+  arrays = {'date':dates[first:last]}
+  for column in columns:
+    if column not in COLUMNS:
+      raise ValueError('unknown column %s' %column)
+    arrays[column] = np.load(os.path.join(path,_column_file(column)),mmap_mode='r')[first:last]
+  return arrays
+
+def sync(symbols):
+  """
+  Rebuild the stale or missing columnar copies of symbols
+  """
+  rebuilt = 0
+  for symbol in symbols:
+    if not os.path.exists(os.path.join(symbol_dir(symbol),MANIFEST)):
+      rebuilt += export_symbol(symbol)
+  return rebuilt
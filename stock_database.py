@@ -1,62 +1,287 @@
 import os
+import re
 import sys
 import shutil
 import pdb
 import sqlite3
-from stock_class import stock
+import datetime
+import threading
+import contextlib
+import numpy as np
 import pandas as pd
 import stock_helper
+import stock_download
+import stock_cache
+import stock_columnar
 
 """
 Helper functions to download stock market data from yahoo finance API and store it into
 a sqlite database.
 
-The database contain one relation per ticker symbol. The columns in the relation
-are "open", "high", "low", "close", "volume", "adj close"
+Two storage layouts are supported:
+  - "per_symbol": one relation per ticker symbol. The columns in the relation
+    are "open", "high", "low", "close", "volume", "adj close"
+  - "long": a single "prices" relation with the same columns plus "symbol", keyed on
+    (symbol, date). Use migrate_to_long_format to convert a per_symbol database.
+The layout is detected from the database (or forced with LAYOUT), callers do not change.
+
+Dates are keyed either as '%Y.%m.%d' text or as YYYYMMDD integers (compact keys, faster
+range scans and sorts). The encoding is detected per table from its declared type, new
+tables use INTEGER_DATES, and migrate_dates converts an existing database. Dates are
+encoded and decoded in one vectorized pass at the boundary, callers only see dates.
+
+Derived tables are maintained in the write path, in the long format whatever the layout:
+daily simple and log returns (RETURNS) and weekly and monthly OHLCV bars (WEEKLY,
+MONTHLY). Only the tail affected by the new rows is recomputed. Use backfill_derived to
+build them for an existing database. The METRICS table (see stock_screener) holds the
+analytics of each symbol, the write path only marks the symbol as stale there.
 """
 
+DB_PATH = '/home/gilles/projects/trading/quant_trading/database/market.db'
+LAYOUT = None                 # None: detect, 'per_symbol' or 'long' to force a layout
+INTEGER_DATES = False         # date type of the new tables: YYYYMMDD INTEGER, or '%Y.%m.%d' TEXT
+PRICE_TABLE = 'prices'
+STAGING_TABLE = 'prices__staging'   # prices table being built by migrate_to_long_format
+RETURNS_TABLE = 'RETURNS'
+ROLLUP_TABLES = {'W':'WEEKLY','M':'MONTHLY'}
+METRICS_TABLE = 'METRICS'
+METRIC_COLUMNS = ['Sharpe','Volatility','Hurst','Half_life','VR_stat','VR_pvalue','ADF_stat','ADF_pvalue']
+NON_PRICE_TABLES = set(['SUMMARY',PRICE_TABLE,STAGING_TABLE,'PAIRS',RETURNS_TABLE,METRICS_TABLE]+ROLLUP_TABLES.values())
+PRICE_COLUMNS = 'date,Open,High,Low,Close,Volume,Adj_Close'
+
+_TABLES = set()               # (database, table) pairs known to exist
+_DATE_TYPES = {}              # (database, table) - True if the dates are integers
+_LAYOUTS = {}                 # database - detected storage layout
+
+# WAL lets the analytics read while an ingest is writing, synchronous=NORMAL is safe in
+# WAL mode and only syncs at checkpoints, 64MB page cache and 256MB of memory-mapped I/O
+PRAGMAS = {'journal_mode':'WAL','synchronous':'NORMAL','cache_size':-65536,'mmap_size':268435456}
+_MANAGERS = {}                # database path - ConnectionManager
+
+class ConnectionManager:
+  """
+  Connections to one database, tuned with PRAGMAS. Each thread (of each process) gets its
+  own connection, created on first use and then reused: sqlite connections cannot be
+  shared between threads, and a forked process must not reuse the connections of its parent
+  """
+  def __init__(self,path,timeout=30.,**pragmas):
+    self._path = path
+    self._timeout = timeout
+    self._pragmas = pragmas
+    self._connections = {}
+    self._lock = threading.Lock()
+
+  def path(self):
+    return self._path
+
+  def connect(self):
+    """
+    New tuned connection, owned (and closed) by the caller
+    """
+    db = sqlite3.connect(self._path,timeout=self._timeout)
+    for name,value in sorted(self._pragmas.items()):
+      if value is not None:
+        db.execute('PRAGMA %s=%s' %(name,value))
+    return db
+
+  def get(self):
+    """
+    Connection of the calling thread
+    """
+    key = (os.getpid(),threading.current_thread().ident)
+    db = self._connections.get(key)
+    if db is None:
+      db = self.connect()
+      with self._lock:
+        self._connections[key] = db
+    return db
+
+  def release(self):
+    """
+    Close the connection of the calling thread
+    """
+    with self._lock:
+      db = self._connections.pop((os.getpid(),threading.current_thread().ident),None)
+    if db is not None:
+      db.close()
+
+  @contextlib.contextmanager
+  def transaction(self):
+    """
+    with manager.transaction() as cur: ... commits at the end of the block, or rolls
+    back if it raises. The transaction is explicit (BEGIN IMMEDIATE ... COMMIT), the
+    connection being switched to autocommit mode for the block: otherwise the sqlite3
+    module commits on its own before every CREATE or PRAGMA run in the block
+    """
+    db = self.get()
+    level = db.isolation_level
+    db.isolation_level = None          # also commits what the caller left pending
+    cur = db.cursor()
+    try:
+      cur.execute('BEGIN IMMEDIATE')
+      try:
+        yield cur
+        cur.execute('COMMIT')
+      except:
+        cur.execute('ROLLBACK')
+        forget_tables(self._path)
+        raise
+    finally:
+      db.isolation_level = level
+
+def manager():
+  """
+  Connection manager of the current database (DB_PATH)
+  """
+  if DB_PATH not in _MANAGERS:
+    _MANAGERS[DB_PATH] = ConnectionManager(DB_PATH,**PRAGMAS)
+  return _MANAGERS[DB_PATH]
+
+def configure(path=None,**pragmas):
+  """
+  Change the database path and/or the PRAGMAS of the new connections
+  (e.g. configure('/data/market.db',synchronous='FULL'))
+  """
+  global DB_PATH
+  if path is not None:
+    DB_PATH = path
+  if pragmas:
+    PRAGMAS.update(pragmas)
+    _MANAGERS.pop(DB_PATH,None)
+  return manager()
+
 def connection():
   """
-  connect to the database on disk and creates the cursor object
+  connection of the calling thread to the database on disk (reused between calls, do not
+  close it) and a new cursor object
   """
-  # "Connect" to the database
-  db = sqlite3.connect('/home/gilles/projects/trading/quant_trading/database/market.db')
+  db = manager().get()
   # Create a "cursor" object that will pass the SQL statements and execute them
-  cur = db.cursor()  
+  cur = db.cursor()
   return db,cur
 
+def transaction():
+  """
+  with transaction() as cur: ... runs the block in one transaction on the connection of
+  the calling thread
+  """
+  return manager().transaction()
+
 def update_summary_table(symbol):
   """
   If information about the symbol is not known yet (stock_type, sector, industry/activity),
   create a new entry in the summary table
   """
-  try:
-    if not cur:
-      db,cur = connection()
-  except:
-    db,cur = connection()
+  with transaction() as cur:
+    write_summary(cur,symbol)
+  return
 
-  dic = stock_helper.load_symbol_dic()
+def write_summary(cur,symbol,dic=None):
+  """
+  Insert the summary entry of symbol with an existing cursor (no commit).
+  dic is the symbol dictionary, loaded if not provided
+  """
+  if dic is None:
+    dic = stock_helper.load_symbol_dic()
   info = dic[symbol]
-
   cur.execute('INSERT OR IGNORE INTO SUMMARY(Symbol,Name,Type,Sector,Industry) VALUES(?,?,?,?,?)', (symbol,info[0],info[1],info[2],info[3]))
-  db.commit()
-  db.close()
-  return  
+
+def _quote(name):
+  """
+  Quote a table name, ticker symbols are not always valid SQL identifiers
+  """
+  return '"%s"' %name.replace('"','""')
+
+def _table_exists(cur,name):
+  """
+  Check sqlite_master once per table and process, instead of at every call
+  """
+  if (DB_PATH,name) not in _TABLES:
+    cur.execute('SELECT name FROM sqlite_master WHERE type="table" AND name=?',(name,))
+    if cur.fetchone():
+      _TABLES.add((DB_PATH,name))
+  return (DB_PATH,name) in _TABLES
+
+def forget_tables(path=None):
+  """
+  Clear the cached tables and date types of the database at path (default: DB_PATH).
+  Called after a rollback, which may have undone the creation of the cached tables
+  """
+  path = DB_PATH if path is None else path
+  for key in [key for key in _TABLES if key[0] == path]:
+    _TABLES.discard(key)
+  for key in [key for key in _DATE_TYPES if key[0] == path]:
+    del _DATE_TYPES[key]
+  _LAYOUTS.pop(path,None)
+
+def _date_type():
+  """
+  SQL type of the date keys of a new table
+  """
+  return 'INTEGER' if INTEGER_DATES else 'TEXT'
+
+def _integer_dates(cur,table):
+  """
+  True if the dates of table are YYYYMMDD integers, False for '%Y.%m.%d' text. Read from
+  the declared type of its date column once per table and process (a table which does
+  not exist yet will be created with INTEGER_DATES)
+  """
+  key = (DB_PATH,table)
+  if key not in _DATE_TYPES:
+    cur.execute('PRAGMA table_info(%s)' %_quote(table))
+    types = dict((row[1],row[2].upper()) for row in cur.fetchall())
+    if not types:
+      return INTEGER_DATES
+    _DATE_TYPES[key] = types.get('date') == 'INTEGER'
+  return _DATE_TYPES[key]
+
+def storage_layout(cur):
+  """
+  Return 'long' if the prices are stored in the single prices table, 'per_symbol'
+  if there is one table per ticker. The layout is detected once per database and
+  process (other processes must be restarted after a migration)
+  """
+  if LAYOUT is not None:
+    return LAYOUT
+  if DB_PATH not in _LAYOUTS:
+    _LAYOUTS[DB_PATH] = 'long' if _table_exists(cur,PRICE_TABLE) else 'per_symbol'
+  return _LAYOUTS[DB_PATH]
+
+def _create_price_table(cur,name=PRICE_TABLE):
+  """
+  Single long-format table. The (symbol, date) primary key serves both the per-symbol
+  range scans and the de-duplication, WITHOUT ROWID stores the rows in key order
+  """
+  cur.execute('CREATE TABLE IF NOT EXISTS %s(symbol TEXT NOT NULL, date %s NOT NULL, Open REAL, High REAL, Low REAL, Close REAL, Volume INTEGER, Adj_Close REAL, PRIMARY KEY(symbol,date)) WITHOUT ROWID' %(name,_date_type()))
+  _TABLES.add((DB_PATH,name))
+
+def _ensure_table(cur,symbol):
+  """
+  Make sure the table receiving the rows of symbol exists
+  """
+  if storage_layout(cur) == 'long':
+    if not _table_exists(cur,PRICE_TABLE):
+      _create_price_table(cur)
+  elif not _table_exists(cur,symbol):
+    cur.execute('CREATE TABLE IF NOT EXISTS %s(date %s PRIMARY KEY, Open REAL, High REAL, Low REAL, Close REAL, Volume INTEGER, Adj_Close REAL)' %(_quote(symbol),_date_type()))
+    _TABLES.add((DB_PATH,symbol))
+
+def _insert_statement(cur,symbol):
+  """
+  INSERT statement for the rows of symbol, and whether the rows must be prefixed
+  with the symbol
+  """
+  if storage_layout(cur) == 'long':
+    return 'INSERT OR IGNORE INTO %s(symbol,%s) VALUES(?,?,?,?,?,?,?,?)' %(PRICE_TABLE,PRICE_COLUMNS), True
+  return 'INSERT OR IGNORE INTO %s(%s) VALUES(?,?,?,?,?,?,?)' %(_quote(symbol),PRICE_COLUMNS), False
 
 def create_table(symbol):
   """
   If the historical table for the stock does not exist, create it
+  (the shared prices table in the long layout)
   """
-  try:
-    if not cur:
-      db,cur = connection()
-  except:
-    db,cur = connection()
-
-  cur.execute('CREATE TABLE %s(date TEXT PRIMARY KEY, Open REAL, High REAL, Low REAL, Close REAL, Volume INTEGER, Adj_Close REAL)' %symbol)
-  # Commit the changes
-  db.commit()
+  with transaction() as cur:
+    _ensure_table(cur,symbol)
   return
   
 def update_data(stk):
@@ -64,11 +289,7 @@ def update_data(stk):
   Update the database with historical data (only update for entries
   that do not currently exist
   """
-  try:
-    if not cur:
-      db,cur = connection()
-  except:
-    db,cur = connection()
+  db,cur = connection()
 
   symbol = stk._symbol
   start = stk._start
@@ -77,99 +298,645 @@ def update_data(stk):
   data = stk._historical   #remember to retrieve historical data before calling the function
 
   # Check if the table for the symbol already exists in the database
-  cur.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="%s"' %symbol)
-  table = cur.fetchall()
-  if not table:
-    try:
-      create_table(symbol)
-    except:
-      # update relative to previous date?
-      return
+  try:
+    _ensure_table(cur,symbol)
+  except:
+    # update relative to previous date?
+    return
+  statement,prefix = _insert_statement(cur,symbol)
 
-  for i in xrange(len(data)):
-    date = pd.to_datetime(str(data.index.values[i])).strftime('%Y.%m.%d')
-    values = data.iloc[i]
-    cur.execute('INSERT OR IGNORE INTO %s(date,Open,High,Low,Close,Volume,Adj_Close) VALUES(?,?,?,?,?,?,?)' %symbol, (date,values[0],values[1],values[2],values[3],values[4],values[5]))
+  # the date keys are all converted at once, the rows are still written one by one
+  for row in _historical_rows(data,_integer_dates(cur,PRICE_TABLE if prefix else symbol)):
+    if prefix:
+      row = (symbol,)+row
+    cur.execute(statement,row)
     db.commit()
-  db.close()
+  if len(data):
+    refresh_derived(cur,symbol,pd.to_datetime(data.index).min())
+    mark_stale(cur,symbol)
+    db.commit()
+  data_changed([symbol])
   return
 
-def full_download(start):
+def data_changed(symbols):
+  """
+  New rows of symbols were committed: drop the cached results and columnar copies
+  derived from their previous data. Called by the owner of the transaction once it is
+  committed, so that no other process can rebuild them from the old rows in between
+  """
+  for symbol in symbols:
+    stock_cache.invalidate(symbol)
+    stock_columnar.invalidate(symbol)
+
+def _date_keys(index,integer=False):
+  """
+  Convert the dates of a historical index into the '%Y.%m.%d' strings (or YYYYMMDD
+  integers) used as primary key, in one vectorized pass
+  """
+  days = pd.to_datetime(index).values.astype('datetime64[D]')
+  if integer:
+    months = days.astype('datetime64[M]')
+    years = days.astype('datetime64[Y]')
+    return ((years.astype(np.int64)+1970)*10000
+            +((months-years.astype('datetime64[M]')).astype(np.int64)+1)*100
+            +(days-months.astype('datetime64[D]')).astype(np.int64)+1)
+  return np.char.replace(np.datetime_as_string(days),'-','.')
+
+HISTORICAL_COLUMNS = ['Open','High','Low','Close','Volume','Adj Close']
+
+def _column_name(column):
+  """
+  Name of a historical column in the database ("Adj Close" is stored as Adj_Close)
+  """
+  name = column.replace(' ','_')
+  if name not in PRICE_COLUMNS.split(','):
+    raise ValueError('unknown column %s' %column)
+  return name
+
+def _date_key(date,integer=False):
+  """
+  Convert a single date into the '%Y.%m.%d' key (or YYYYMMDD integer) used in the database
+  """
+  if integer:
+    return int(pd.to_datetime(date).strftime('%Y%m%d'))
+  return pd.to_datetime(date).strftime('%Y.%m.%d')
+
+def _parse_date_keys(keys):
+  """
+  Convert a sequence of '%Y.%m.%d' keys or YYYYMMDD integers into a datetime64[D] array,
+  in one pass (the integers are split into year, month and day offsets)
+  """
+  keys = np.asarray(keys)
+  if keys.dtype.kind in 'iu':
+    months = (keys//10000-1970).astype('datetime64[Y]').astype('datetime64[M]')+(keys//100%100-1)
+    return months.astype('datetime64[D]')+(keys%100-1)
+  return np.char.replace(keys.astype(str),'.','-').astype('datetime64[D]')
+
+def _historical_rows(data,integer=False):
+  """
+  Turn a historical dataframe (yahoo finance format) into a list of
+  (date,Open,High,Low,Close,Volume,Adj_Close) tuples ready for executemany
+  """
+  dates = _date_keys(data.index,integer).tolist()
+  prices = [data[col].values.tolist() for col in ['Open','High','Low','Close']]
+  volume = data['Volume'].values.astype(np.int64).tolist()
+  adj_close = data['Adj Close'].values.tolist()
+  return zip(dates,*(prices+[volume,adj_close]))
+
+def write_historical(cur,symbol,data,derived=True):
+  """
+  Insert all the rows of a historical dataframe for symbol with a single executemany.
+  The caller owns the transaction (nothing is committed here) and calls data_changed
+  for the symbols with new rows after the commit.
+  With derived=True, the derived tables are updated from the first date of data onwards
+  (bulk loads can pass False and run backfill_derived once at the end).
+  Returns the number of rows inserted and skipped (already in the database)
+  """
+  if not len(data):
+    return 0,0
+  _ensure_table(cur,symbol)
+  statement,prefix = _insert_statement(cur,symbol)
+  rows = _historical_rows(data,_integer_dates(cur,PRICE_TABLE if prefix else symbol))
+  since = min(row[0] for row in rows)
+  if prefix:
+    rows = [(symbol,)+row for row in rows]
+  before = cur.connection.total_changes
+  cur.executemany(statement,rows)
+  inserted = cur.connection.total_changes - before
+  if inserted:
+    if derived:
+      refresh_derived(cur,symbol,_parse_date_keys([since])[0])
+    mark_stale(cur,symbol)
+  return inserted, len(rows)-inserted
+
+def update_data_bulk(stocks):
+  """
+  Bulk version of update_data. Accepts one stock or a list of stocks (historical data
+  already retrieved) and writes all of them in one transaction.
+  Returns a dictionary {symbol - (rows inserted, rows skipped)}
+  Use update_data (one row at a time) as a fallback if the bulk write fails
+  """
+  if not isinstance(stocks,(list,tuple)):
+    stocks = [stocks]
+  report = {}
+  with transaction() as cur:
+    for stk in stocks:
+      report[stk._symbol] = write_historical(cur,stk._symbol,stk._historical)
+  data_changed([symbol for symbol,counts in report.items() if counts[0]])
+  return report
+
+def _as_date(date):
+  """
+  Accept a datetime.date or a dd/mm/yyyy string (format of the stock class)
+  """
+  if isinstance(date,datetime.date):
+    return date
+  date,check = stock_helper.check_date_format(date)
+  if check == 'fail':
+    raise ValueError('please use the correct format for the date, dd/mm/yyyy')
+  return date
+
+def full_download(start,checkpoint=None,**options):
   """
-  Download all the data from yahoo.finance from start to today
-  (takes several days)
+  Download all the data from yahoo.finance from start (datetime.date or dd/mm/yyyy)
+  to today, with the concurrent downloader of stock_download.
+  The symbols already stored are listed in the checkpoint file (default: next to the
+  database, one file per start date), an interrupted download resumes from there. The
+  default checkpoint is removed once a run ends without failed symbols, so that the next
+  full download starts over.
+  options are passed to stock_download.download (workers, rate, retries, source...)
   """
   symbols = stock_helper.load_symbol_dic()
+  symbols = [key for key in symbols if '^' not in key and '/' not in key]
 
-  con = sqlite3.connect('/home/gilles/projects/trading/quant_trading/database/market.db')
-  cur = con.cursor()
-  cur.execute('SELECT name FROM sqlite_master WHERE type="table"')
-  tables = cur.fetchall()
+  start = _as_date(start)
+  own_checkpoint = checkpoint is None
+  if own_checkpoint:
+    checkpoint = os.path.join(os.path.dirname(DB_PATH),'full_download_%s.checkpoint' %start.strftime('%Y%m%d'))
 
-  for key in symbols.keys():
-    if '^' in key or '/' in key:
-      del symbols[key]
-      continue
-#    if (key,) in tables:
-#      cur.execute('SELECT COUNT(*) FROM %s' %key)
-#      entries = cur.fetchall()
-#      pdb.set_trace()
-#      if entries[0][0] > 0:
-#        del symbols[key]
-  print len(symbols)
-
-#  sys.exit()
-  for item in symbols:
-    stk = stock(item,start)
-    try:
-      stk.get_historical()
-    except:
-      continue
+  report = stock_download.download(symbols,start,checkpoint=checkpoint,**options)
+  if own_checkpoint and not report['failed'] and os.path.exists(checkpoint):
+    os.remove(checkpoint)
+  print '%d symbols stored (%d rows), %d already done, %d empty, %d failed' %(report['stored'],
+        report['rows'],report['skipped'],len(report['empty']),len(report['failed']))
+  return report
 
-    try:
-      update_summary_table(stk._symbol)
-      update_data(stk)
-    except:
-      continue
-    print '%s completed' %stk._symbol
-  return
+def latest_dates(symbols=None):
+  """
+  Latest date stored for each symbol, in a single query (chunked UNION ALL in the
+  per_symbol layout, sqlite limits the number of terms of a compound select).
+  Returns a dictionary {symbol - datetime.date}, symbols without data are absent
+  """
+  db,cur = connection()
+  latest = {}
+  if storage_layout(cur) == 'long':
+    cur.execute('SELECT symbol,MAX(date) FROM %s GROUP BY symbol' %PRICE_TABLE)
+    rows = cur.fetchall()
+  else:
+    # one listing of the tables instead of one lookup per symbol
+    cur.execute('SELECT name FROM sqlite_master WHERE type="table"')
+    existing = set(name for (name,) in cur.fetchall() if name not in NON_PRICE_TABLES and not name.startswith('sqlite_'))
+    if symbols is None:
+      symbols = sorted(existing)
+    tables = [symbol for symbol in symbols if symbol in existing]
+    rows = []
+    for i in xrange(0,len(tables),500):
+      chunk = tables[i:i+500]
+      query = ' UNION ALL '.join('SELECT ?,MAX(date) FROM %s' %_quote(symbol) for symbol in chunk)
+      cur.execute(query,chunk)
+      rows += cur.fetchall()
+  wanted = None if symbols is None else set(symbols)
+  for symbol,date in rows:
+    if date is not None and (wanted is None or symbol in wanted):
+      latest[symbol] = _parse_date_keys([date])[0].tolist()
+  return latest
 
-def regular_download(start=None):
+def last_trading_day(today=None):
+  """
+  Today, or the previous friday during the week-end
+  """
+  if today is None:
+    today = datetime.date.today()
+  while today.weekday() > 4:
+    today -= datetime.timedelta(1)
+  return today
+
+CSV_ROW_BYTES = 56     # size of one line of a yahoo csv quote, to estimate the transfer saved
+
+def incremental_download(start=None,**options):
+  """
+  Only download the missing dates of each symbol: from the day after its latest stored
+  date to today. Symbols already up to date are skipped, and symbols sharing the same gap
+  are downloaded as one batch. Symbols not in the database yet are downloaded from start
+  (default: 30 days ago, like the regular download).
+  options are passed to stock_download.download
+  """
+  today = datetime.date.today()
+  if start is None:
+    start = today-datetime.timedelta(365/12)
+  start = _as_date(start)
+  symbols = [key for key in stock_helper.load_symbol_dic() if '^' not in key and '/' not in key]
+  latest = latest_dates(symbols)
+  current = last_trading_day(today)
+
+  gaps = {}
+  for symbol in symbols:
+    if symbol not in latest:
+      gaps.setdefault(start,[]).append(symbol)
+    elif latest[symbol] < current:
+      gaps.setdefault(latest[symbol]+datetime.timedelta(1),[]).append(symbol)
+  fetched = sum(len(group) for group in gaps.values())
+
+  # rows of the fixed window that the regular download would have requested again
+  window = np.busday_count(start,today+datetime.timedelta(1))
+  avoided_rows = (len(symbols)-fetched)*window
+  for gap_start,group in sorted(gaps.items()):
+    avoided_rows += len(group)*max(0,np.busday_count(start,gap_start))
+    print 'downloading %d symbols from %s' %(len(group),gap_start)
+    stock_download.download(group,gap_start,today,**options)
+
+  print '%d symbols up to date and skipped, %d downloaded in %d batches' %(len(symbols)-fetched,fetched,len(gaps))
+  print 'about %d rows (%.1f MB) not fetched again' %(avoided_rows,avoided_rows*CSV_ROW_BYTES/1e6)
+  return gaps
+
+def regular_download(start=None,incremental=False,**options):
   """
   Download last month of data for all symbols, to update the database regularly
+  With incremental=True, only the dates missing from the database are downloaded
+  (see incremental_download)
   """
-  symbols = stock_helper.load_symbol_dic()
-  
-  for item in symbols:
-    if start == None:
-      stk = stock(item)
-    else:
-      stk = stock(item,start)
-    try:
-      stk.get_historical()
-      update_summary_table(stk._symbol)
-      update_data(stk)
-      print 'updated %s' %item
-    except:
-      continue
-  return
+  if incremental:
+    return incremental_download(start,**options)
+  if start is None:
+    start = datetime.date.today()-datetime.timedelta(365/12)
+  report = stock_download.download(stock_helper.load_symbol_dic().keys(),_as_date(start),**options)
+  print '%d symbols updated (%d new rows), %d empty, %d failed' %(report['stored'],report['rows'],
+        len(report['empty']),len(report['failed']))
+  return report
 
-def extract_series(symbol):
+def _price_source(cur,symbol):
   """
-  Get the stock data between start and end from the sqlite database
+  Table holding the prices of symbol, with the WHERE terms and parameters selecting them
+  and whether its dates are integers. None if the symbol is not in the database
   """
-  try:
-    if not cur:
-      db,cur = connection()
-  except:
-    db,cur = connection()
+  if storage_layout(cur) == 'long':
+    return PRICE_TABLE,['symbol=?'],[symbol],_integer_dates(cur,PRICE_TABLE)
+  if _table_exists(cur,symbol):
+    return _quote(symbol),[],[],_integer_dates(cur,symbol)
+  return None
+
+def _create_derived_tables(cur):
+  """
+  Returns and weekly/monthly bars, keyed on (symbol, date) and (symbol, first day of the
+  period). A bar is dated by its last trading day
+  """
+  if _table_exists(cur,RETURNS_TABLE):
+    return
+  for table in ROLLUP_TABLES.values():
+    cur.execute('CREATE TABLE IF NOT EXISTS %s(symbol TEXT NOT NULL, period %s NOT NULL, date %s NOT NULL, Open REAL, High REAL, Low REAL, Close REAL, Volume INTEGER, Adj_Close REAL, PRIMARY KEY(symbol,period)) WITHOUT ROWID' %(table,_date_type(),_date_type()))
+    _TABLES.add((DB_PATH,table))
+  cur.execute('CREATE TABLE IF NOT EXISTS %s(symbol TEXT NOT NULL, date %s NOT NULL, Simple REAL, Log REAL, PRIMARY KEY(symbol,date)) WITHOUT ROWID' %(RETURNS_TABLE,_date_type()))
+  _TABLES.add((DB_PATH,RETURNS_TABLE))
+
+def create_metrics_table(cur):
+  """
+  Metrics of each symbol (one row per symbol, joined to SUMMARY on Symbol), with an index
+  on every metric column. Stale is set when new prices are written, Version counts the
+  writes so that a refresh running concurrently does not clear a newer mark
+  """
+  if _table_exists(cur,METRICS_TABLE):
+    return
+  columns = ', '.join('%s REAL' %column for column in METRIC_COLUMNS)
+  cur.execute('CREATE TABLE IF NOT EXISTS %s(Symbol TEXT PRIMARY KEY, Stale INTEGER NOT NULL DEFAULT 1, Version INTEGER NOT NULL DEFAULT 0, Updated TEXT, Rows INTEGER, First TEXT, Last TEXT, %s)' %(METRICS_TABLE,columns))
+  for column in METRIC_COLUMNS+['Stale']:
+    cur.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s(%s)' %(METRICS_TABLE,column,METRICS_TABLE,column))
+  _TABLES.add((DB_PATH,METRICS_TABLE))
+
+def mark_stale(cur,symbol):
+  """
+  New prices were written for symbol: its metrics must be refreshed (no commit)
+  """
+  create_metrics_table(cur)
+  cur.execute('INSERT OR IGNORE INTO %s(Symbol) VALUES(?)' %METRICS_TABLE,(symbol,))
+  cur.execute('UPDATE %s SET Stale=1, Version=Version+1 WHERE Symbol=?' %METRICS_TABLE,(symbol,))
+
+def _period_starts(dates,freq):
+  """
+  First day of the week (Monday, freq='W') or of the month (freq='M') of each date
+  """
+  days = np.asarray(dates,dtype='datetime64[D]')
+  if freq == 'W':
+    return days-(days.astype(np.int64)+3)%7        # 1970-01-01 was a Thursday
+  return days.astype('datetime64[M]').astype('datetime64[D]')
+
+def refresh_derived(cur,symbol,since=None):
+  """
+  Recompute the derived rows of symbol affected by prices written from the date since
+  (datetime64 or datetime.date, None for the whole history): the returns from since
+  onwards, and the weekly and monthly bars from the start of the week / month of since.
+  Only this tail of the prices is read. The caller owns the transaction.
+  Returns the number of daily returns written
+  """
+  source = _price_source(cur,symbol)
+  if source is None:
+    return 0
+  table,where,params,integer = source
+  _create_derived_tables(cur)
+  read_from = None
+  if since is not None:
+    since = np.datetime64(since,'D')
+    read_from = min(_period_starts([since],'W')[0],_period_starts([since],'M')[0])
+    # the first new return needs the previous stored price
+    cur.execute('SELECT MAX(date) FROM %s WHERE %s' %(table,' AND '.join(where+['date<?'])),
+                params+[_date_key(since,integer)])
+    previous = cur.fetchone()[0]
+    if previous is not None:
+      read_from = min(read_from,_parse_date_keys([previous])[0])
+    where = where+['date>=?']
+    params = params+[_date_key(read_from,integer)]
+  query = 'SELECT %s FROM %s' %(PRICE_COLUMNS,table)
+  if where:
+    query += ' WHERE ' + ' AND '.join(where)
+  cur.execute(query + ' ORDER BY date',params)
+  rows = cur.fetchall()
+  if not rows:
+    return 0
+
+  values = zip(*rows)
+  dates = _parse_date_keys(values[0])
+  data = pd.DataFrame(dict((column,np.array(value,dtype=np.float64)) for column,value in zip(HISTORICAL_COLUMNS,values[1:])),
+                      index=pd.DatetimeIndex(dates),columns=HISTORICAL_COLUMNS)
+
+  adj_close = data['Adj Close'].values
+  with np.errstate(invalid='ignore',divide='ignore'):
+    ratio = adj_close[1:]/adj_close[:-1]
+  keep = slice(None) if since is None else dates[1:] >= since
+  returns = zip(_date_keys(dates[1:][keep],_integer_dates(cur,RETURNS_TABLE)).tolist(),
+                (ratio[keep]-1).tolist(),np.log(ratio[keep]).tolist())
+  cur.executemany('INSERT OR REPLACE INTO %s(symbol,date,Simple,Log) VALUES(?,?,?,?)' %RETURNS_TABLE,
+                  [(symbol,)+row for row in returns])
+
+  for freq,rollup in ROLLUP_TABLES.items():
+    bars = stock_helper.resample_ohlcv(data,freq)
+    periods = _period_starts(bars.index.values,freq)
+    if since is not None:
+      keep = periods >= _period_starts([since],freq)[0]
+      bars,periods = bars[keep],periods[keep]
+    integer = _integer_dates(cur,rollup)
+    bar_rows = zip(_date_keys(periods,integer).tolist(),_historical_rows(bars,integer))
+    cur.executemany('INSERT OR REPLACE INTO %s(symbol,period,%s) VALUES(?,?,?,?,?,?,?,?,?)' %(rollup,PRICE_COLUMNS),
+                    [(symbol,period)+row for period,row in bar_rows])
+  return len(returns)
 
-  cur.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="%s"' %symbol)
-  table = cur.fetchall()
-  if not table:
+def backfill_derived(symbols=None):
+  """
+  Build the derived tables of an existing database from the stored prices, one
+  transaction per symbol (an interrupted backfill can simply be run again).
+  Default: every symbol of the database. Returns the number of symbols processed
+  """
+  if symbols is None:
+    symbols = sorted(latest_dates())
+  print '%d symbols to backfill' %len(symbols)
+  for i,symbol in enumerate(symbols):
+    with transaction() as cur:
+      refresh_derived(cur,symbol)
+    if (i+1)%500 == 0:
+      print '%d symbols done' %(i+1)
+  return len(symbols)
+
+def _select_derived(table,symbol,start,end,selected):
+  """
+  Rows of symbol in a derived table between start and end (both included), ordered by
+  date. None if the derived tables were not built
+  """
+  db,cur = connection()
+  if not _table_exists(cur,table):
+    print 'no %s table, run "python stock_database.py backfill"' %table
+    return
+  integer = _integer_dates(cur,table)
+  where,params = ['symbol=?'],[symbol]
+  if start is not None:
+    where.append('date>=?')
+    params.append(_date_key(start,integer))
+  if end is not None:
+    where.append('date<=?')
+    params.append(_date_key(end,integer))
+  cur.execute('SELECT %s FROM %s WHERE %s ORDER BY date' %(selected,table,' AND '.join(where)),params)
+  return cur.fetchall()
+
+def extract_returns(symbol,start=None,end=None,log=False):
+  """
+  Precomputed daily returns of symbol between start and end (both included): a
+  dictionary {'date' - datetime64[D] array, 'return' - float array} of simple returns,
+  or of log returns with log=True. Each return is relative to the previous stored day
+  """
+  rows = _select_derived(RETURNS_TABLE,symbol,start,end,'date,Log' if log else 'date,Simple')
+  if rows is None:
+    return
+  values = zip(*rows) if rows else [(),()]
+  return {'date':_parse_date_keys(values[0]),'return':np.array(values[1],dtype=np.float64)}
+
+def extract_rollup(symbol,freq='W',start=None,end=None,columns=None):
+  """
+  Precomputed weekly (freq='W') or monthly (freq='M') bars of symbol whose last trading
+  day is between start and end, in the format of extract_series(...,as_arrays=True)
+  (bars dated by their last trading day)
+  """
+  if freq not in ROLLUP_TABLES:
+    raise ValueError('unknown frequency %s, use "W" or "M"' %freq)
+  if columns is None:
+    columns = HISTORICAL_COLUMNS
+  selected = ','.join(['date']+[_column_name(col) for col in columns])
+  rows = _select_derived(ROLLUP_TABLES[freq],symbol,start,end,selected)
+  if rows is None:
+    return
+  values = zip(*rows) if rows else [()]*(len(columns)+1)
+  arrays = {'date':_parse_date_keys(values[0])}
+  for col,value in zip(columns,values[1:]):
+    arrays[col] = np.array(value,dtype=np.float64)
+  return arrays
+
+def extract_series(symbol,start=None,end=None,columns=None,as_arrays=False):
+  """
+  Get the stock data between start and end (both included) from the sqlite database.
+  The date range and the column list are pushed down into the SQL query, which scans
+  the date primary key instead of loading the whole history.
+
+  Parameters:
+      - start, end : datetime.date (or anything pd.to_datetime understands), optional
+      - columns : list of columns among "Open", "High", "Low", "Close", "Volume",
+                  "Adj Close". Default is all of them. The date always comes first
+      - as_arrays : if True, return a dictionary {column - numpy array} with the dates
+                    as datetime64[D] and the values as floats, instead of row tuples
+  """
+  db,cur = connection()
+
+  if columns is None:
+    columns = HISTORICAL_COLUMNS
+  selected = ','.join(['date']+[_column_name(col) for col in columns])
+  source = _price_source(cur,symbol)
+  if source is None:
     print '%s is not in the database' %symbol
     return
-  else:
-    cur.execute('SELECT * FROM %s' %symbol)
-    return cur.fetchall()
+  table,where,params,integer = source
+  if start is not None:
+    where.append('date>=?')
+    params.append(_date_key(start,integer))
+  if end is not None:
+    where.append('date<=?')
+    params.append(_date_key(end,integer))
+  query = 'SELECT %s FROM %s' %(selected,table)
+  if where:
+    query += ' WHERE ' + ' AND '.join(where)
+  cur.execute(query + ' ORDER BY date',params)
+  rows = cur.fetchall()
+  if not rows and start is None and end is None:
+    print '%s is not in the database' %symbol
+    return
+  if not as_arrays:
+    return rows
+
+  values = zip(*rows) if rows else [()]*(len(columns)+1)
+  arrays = {'date':_parse_date_keys(values[0])}
+  for col,value in zip(columns,values[1:]):
+    arrays[col] = np.array(value,dtype=np.float64)
+  return arrays
+
+def migrate_to_long_format(batch_size=50000,drop=False):
+  """
+  Move every per-symbol table of the database into the single prices table.
+  Rows are streamed batch_size at a time and committed table by table, so the migration
+  runs in bounded memory and can be interrupted and restarted (rows already moved are
+  ignored). The rows go to a staging table renamed to prices once every table is copied,
+  so the readers stay on the per-symbol tables until the migration is complete.
+  With drop=True, the per-symbol tables are dropped after the rename.
+  """
+  db = manager().connect()
+  cur = db.cursor()
+  target = PRICE_TABLE if _table_exists(cur,PRICE_TABLE) else STAGING_TABLE
+  _create_price_table(cur,target)
+  db.commit()
+  cur.execute('SELECT name FROM sqlite_master WHERE type="table"')
+  tables = [name for (name,) in cur.fetchall() if name not in NON_PRICE_TABLES and not name.startswith('sqlite_')]
+  print '%d tables to migrate' %len(tables)
+
+  reader = db.cursor()
+  statement = 'INSERT OR IGNORE INTO %s(symbol,%s) VALUES(?,?,?,?,?,?,?,?)' %(target,PRICE_COLUMNS)
+  integer = _integer_dates(cur,target)
+  for symbol in tables:
+    selected = PRICE_COLUMNS.replace('date',_date_sql('date',_integer_dates(cur,symbol),integer),1)
+    reader.execute('SELECT %s FROM %s' %(selected,_quote(symbol)))
+    moved = 0
+    while True:
+      rows = reader.fetchmany(batch_size)
+      if not rows:
+        break
+      cur.executemany(statement,[(symbol,)+tuple(row) for row in rows])
+      moved += len(rows)
+    db.commit()
+    print '%s: %d rows migrated' %(symbol,moved)
+
+  if target == STAGING_TABLE:
+    cur.execute('ALTER TABLE %s RENAME TO %s' %(STAGING_TABLE,PRICE_TABLE))
+    db.commit()
+    _TABLES.discard((DB_PATH,STAGING_TABLE))
+    _TABLES.add((DB_PATH,PRICE_TABLE))
+    _DATE_TYPES.pop((DB_PATH,STAGING_TABLE),None)
+    _LAYOUTS.pop(DB_PATH,None)
+  if drop:
+    for symbol in tables:
+      cur.execute('DROP TABLE %s' %_quote(symbol))
+      _TABLES.discard((DB_PATH,symbol))
+      db.commit()
+  db.close()
+  return
+
+def _date_sql(column,from_integer,to_integer):
+  """
+  SQL expression converting a date column between the text and integer encodings
+  """
+  if from_integer == to_integer:
+    return column
+  if to_integer:
+    return "CAST(REPLACE(%s,'.','') AS INTEGER)" %column
+  return "substr(%s,1,4)||'.'||substr(%s,5,2)||'.'||substr(%s,7,2)" %(column,column,column)
+
+def _check_date_sql(cur,keys=('1999.12.31','2015.01.02','2016.02.29')):
+  """
+  Round trip of sample date keys through the text - integer - text conversions of
+  _date_sql, raises ValueError if a key does not come back unchanged
+  """
+  for key in keys:
+    cur.execute('SELECT %s' %_date_sql('?',False,True),(key,))
+    number = cur.fetchone()[0]
+    cur.execute('SELECT %s' %_date_sql('?',True,False).replace('?','?1'),(number,))
+    back = cur.fetchone()[0]
+    if number != int(key.replace('.','')) or back != key:
+      raise ValueError('date conversion round trip failed: %s - %r - %r' %(key,number,back))
+
+def migrate_dates(integer=True):
+  """
+  Rebuild every table keyed on dates (prices, per-symbol and derived tables) with YYYYMMDD
+  integer dates, or back to '%Y.%m.%d' text with integer=False. Each table is converted
+  in its own transaction, tables already converted are skipped, so an interrupted
+  migration can simply be run again. Set INTEGER_DATES so that new tables follow.
+  Other processes must be restarted (the date type of each table is cached).
+  Returns the number of tables converted
+  """
+  db = manager().connect()
+  db.isolation_level = None          # explicit transactions, DDL included
+  cur = db.cursor()
+  _check_date_sql(cur)
+  cur.execute('SELECT name,sql FROM sqlite_master WHERE type="table"')
+  tables = [(name,sql) for name,sql in cur.fetchall() if not name.startswith('sqlite_')]
+  target = 'INTEGER' if integer else 'TEXT'
+  converted = 0
+  for name,sql in tables:
+    cur.execute('PRAGMA table_info(%s)' %_quote(name))
+    types = [(row[1],row[2].upper()) for row in cur.fetchall()]
+    if dict(types).get('date',target) == target:
+      continue
+    tmp = name+'__dates'
+    create = 'CREATE TABLE %s%s' %(_quote(tmp),sql[sql.index('('):])
+    create = re.sub(r'\b(date|period) (TEXT|INTEGER)\b',r'\1 %s' %target,create)
+    selected = ','.join(_date_sql(_quote(column),declared == 'INTEGER',integer) if column in ('date','period') else _quote(column)
+                        for column,declared in types)
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+      cur.execute('DROP TABLE IF EXISTS %s' %_quote(tmp))
+      cur.execute(create)
+      cur.execute('INSERT INTO %s SELECT %s FROM %s' %(_quote(tmp),selected,_quote(name)))
+      cur.execute('DROP TABLE %s' %_quote(name))
+      cur.execute('ALTER TABLE %s RENAME TO %s' %(_quote(tmp),_quote(name)))
+      cur.execute('PRAGMA table_info(%s)' %_quote(name))
+      declared = dict((row[1],row[2].upper()) for row in cur.fetchall())
+      wrong = [column for column in ('date','period') if declared.get(column,target) != target]
+      if wrong:
+        raise RuntimeError('%s: %s still declared %s after the rebuild' %(name,wrong[0],declared[wrong[0]]))
+      cur.execute('COMMIT')
+    except:
+      cur.execute('ROLLBACK')
+      forget_tables()
+      raise
+    _DATE_TYPES.pop((DB_PATH,name),None)
+    converted += 1
+    if converted%500 == 0:
+      print '%d tables converted' %converted
+  db.close()
+  print '%d tables converted to %s dates' %(converted,target)
+  return converted
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description='market.db maintenance commands')
+  parser.add_argument('--db',default=DB_PATH,help='path of the sqlite database')
+  commands = parser.add_subparsers(dest='command')
+  migrate = commands.add_parser('migrate',help='move the per-symbol tables into the single prices table')
+  migrate.add_argument('--batch-size',type=int,default=50000)
+  migrate.add_argument('--drop',action='store_true',help='drop each per-symbol table once copied')
+  backfill = commands.add_parser('backfill',help='build the returns and weekly/monthly tables from the stored prices')
+  backfill.add_argument('symbols',nargs='*',help='default: every symbol of the database')
+  dates = commands.add_parser('dates',help='convert the date keys of every table to YYYYMMDD integers')
+  dates.add_argument('--text',action='store_true',help="convert back to '%%Y.%%m.%%d' text keys")
+  ingest = commands.add_parser('ingest',help='bulk import of end-of-day csv files (see stock_ingest)')
+  ingest.add_argument('paths',nargs='+')
+  ingest.add_argument('--chunksize',type=int,default=200000)
+  ingest.add_argument('--date-format',help='strptime format of the dates (default: inferred)')
+  ingest.add_argument('--no-derived',action='store_true',help='do not build the derived tables')
+  ingest.add_argument('--run-log',help='JSONL run log')
+  args = parser.parse_args()
+
+  # the other modules import stock_database, not this __main__ copy: configure and run
+  # the commands through the imported module so that they all use the same database
+  import stock_database
+  import stock_ingest
+  stock_database.configure(args.db)
+  if args.command == 'migrate':
+    stock_database.migrate_to_long_format(args.batch_size,args.drop)
+  elif args.command == 'backfill':
+    stock_database.backfill_derived(args.symbols or None)
+  elif args.command == 'dates':
+    stock_database.migrate_dates(not args.text)
+  elif args.command == 'ingest':
+    stock_ingest.ingest_csv(args.paths,args.chunksize,args.date_format,not args.no_derived,run_log=args.run_log)
 
@@ -0,0 +1,356 @@
+import os
+import sys
+import time
+import random
+import datetime
+import threading
+import Queue
+import urllib
+import urllib2
+import StringIO
+import pandas as pd
+from pandas.io.data import DataReader
+import stock_helper
+import stock_database
+import stock_metrics
+import stock_screener
+
+"""
+Concurrent and resumable bulk downloader for the market database.
+
+A bounded pool of worker threads fetches the symbols from a pluggable data source, under
+a shared rate limit and with retries and exponential backoff on network errors. All the
+sqlite writes go through a single writer thread, which commits the symbols by batches and
+records them in a checkpoint file so that an interrupted run resumes where it stopped.
+Fetch latencies, lock wait and commit times, retries and errors are recorded in a
+stock_metrics.RunMetrics (optionally logged to a JSONL file). At the end of the run, the
+metrics of the symbols which received new prices are refreshed (see stock_screener).
+"""
+
+class YahooSource:
+  """
+  Default data source: yahoo finance quotes through pandas DataReader
+  """
+  def fetch(self,symbol,start,end):
+    return DataReader(symbol,'yahoo',start,end)
+
+class CSVSource:
+  """
+  Data source reading yahoo formatted csv quotes (Date,Open,High,Low,Close,Volume,Adj Close)
+  over http, e.g. from a local fake-quote server to benchmark the downloader offline.
+  url is a format string using the symbol, start and end (yyyy-mm-dd) fields, like
+  'http://localhost:8000/quotes?s=%(symbol)s&start=%(start)s&end=%(end)s'
+  """
+  def __init__(self,url,timeout=30):
+    self._url = url
+    self._timeout = timeout
+
+  def fetch(self,symbol,start,end):
+    url = self._url %{'symbol':urllib.quote(symbol),
+                      'start':start.strftime('%Y-%m-%d'),
+                      'end':end.strftime('%Y-%m-%d')}
+    content = urllib2.urlopen(url,timeout=self._timeout).read()
+    data = pd.read_csv(StringIO.StringIO(content),index_col=0,parse_dates=True)
+    return data.sort_index()
+
+class RateLimiter:
+  """
+  Token bucket shared by the workers: at most rate requests per second on average,
+  with bursts of up to burst requests
+  """
+  def __init__(self,rate,burst=1):
+    self._rate = float(rate)
+    self._burst = float(burst)
+    self._tokens = float(burst)
+    self._last = time.time()
+    self._lock = threading.Lock()
+
+  def wait(self):
+    if not self._rate:
+      return
+    while True:
+      with self._lock:
+        now = time.time()
+        self._tokens = min(self._burst,self._tokens+(now-self._last)*self._rate)
+        self._last = now
+        if self._tokens >= 1:
+          self._tokens -= 1
+          return
+        delay = (1-self._tokens)/self._rate
+      time.sleep(delay)
+
+class Checkpoint:
+  """
+  Append-only file with one line per symbol already stored in the database
+  """
+  def __init__(self,path):
+    self._path = path
+    self._done = set()
+    if path and os.path.exists(path):
+      with open(path) as f:
+        self._done = set(line.strip() for line in f if line.strip())
+
+  def __contains__(self,symbol):
+    return symbol in self._done
+
+  def __len__(self):
+    return len(self._done)
+
+  def add(self,symbols):
+    self._done.update(symbols)
+    if self._path:
+      with open(self._path,'a') as f:
+        f.write(''.join('%s\n' %symbol for symbol in symbols))
+
+class _Quotes:
+  """
+  Downloaded frame of a symbol in the form stock_database.update_data expects
+  """
+  def __init__(self,symbol,data):
+    self._symbol = symbol
+    self._historical = data
+    self._start = data.index[0]
+    self._end = data.index[-1]
+
+def fetch_with_retry(source,symbol,start,end,limiter,retries=3,backoff=1.0,metrics=None):
+  """
+  Fetch the quotes of symbol, retrying network errors (IOError) with exponential
+  backoff and jitter. Other exceptions are raised immediately
+  """
+  attempt = 0
+  while True:
+    limiter.wait()
+    started = time.time()
+    try:
+      data = source.fetch(symbol,start,end)
+      if metrics is not None:
+        metrics.observe('fetch',time.time()-started,symbol=symbol,rows=len(data),attempt=attempt)
+      return data
+    except IOError as e:
+      if metrics is not None:
+        metrics.observe('fetch_failed',time.time()-started)
+        metrics.error(e,symbol=symbol,attempt=attempt)
+      if attempt >= retries:
+        raise
+      if metrics is not None:
+        metrics.incr('retries')
+      time.sleep(backoff*(2**attempt)*(1+random.random()))
+      attempt += 1
+
+def _worker(tasks,results,source,start,end,limiter,retries,backoff,metrics):
+  """
+  Fetch symbols from the task queue until it is empty, and pass the data (or the
+  exception) to the writer
+  """
+  while True:
+    try:
+      symbol = tasks.get_nowait()
+    except Queue.Empty:
+      return
+    try:
+      data = fetch_with_retry(source,symbol,start,end,limiter,retries,backoff,metrics)
+      results.put((symbol,data,None))
+    except Exception as e:
+      if not isinstance(e,IOError):
+        metrics.error(e,symbol=symbol)
+      results.put((symbol,None,e))
+
+def _write_batch(cur,batch,symbol_dic,metrics):
+  """
+  Write the summary entries and the historical data of a batch of symbols in one
+  transaction (the connection is in autocommit mode, the transaction is explicit).
+  Returns the number of rows inserted
+  """
+  with metrics.timer('lock_wait'):
+    cur.execute('BEGIN IMMEDIATE')
+  try:
+    inserted = skipped = 0
+    changed = []
+    with metrics.timer('write'):
+      for symbol,data in batch:
+        stock_database.write_summary(cur,symbol,symbol_dic)
+        counts = stock_database.write_historical(cur,symbol,data)
+        inserted += counts[0]
+        skipped += counts[1]
+        if counts[0]:
+          changed.append(symbol)
+    with metrics.timer('commit'):
+      cur.execute('COMMIT')
+  except:
+    cur.execute('ROLLBACK')
+    stock_database.forget_tables()
+    raise
+  stock_database.data_changed(changed)
+  metrics.incr('rows_inserted',inserted)
+  metrics.incr('rows_skipped',skipped)
+  return inserted
+
+def _drain(queue):
+  """
+  Remove every item waiting in queue
+  """
+  while True:
+    try:
+      queue.get_nowait()
+    except Queue.Empty:
+      return
+
+def _writer(tasks,results,checkpoint,report,batch_size,flush_interval,metrics,failure):
+  """
+  Single writer: commit the downloaded symbols by batches of batch_size (or every
+  flush_interval seconds), then record them in the checkpoint.
+  If the writer fails, the exception is appended to failure (to be raised by download),
+  the remaining tasks are dropped and the results consumed so that no worker blocks
+  """
+  db = None
+  finished = False
+  try:
+    # dedicated connection, in autocommit mode so that the transactions are explicit
+    db = stock_database.manager().connect()
+    db.isolation_level = None
+    cur = db.cursor()
+    symbol_dic = stock_helper.load_symbol_dic()
+    while not finished:
+      batch = []
+      deadline = time.time()+flush_interval
+      while len(batch) < batch_size:
+        try:
+          item = results.get(timeout=max(0.01,deadline-time.time()))
+        except Queue.Empty:
+          break
+        if item is None:
+          finished = True
+          break
+        symbol,data,error = item
+        if error is not None:
+          report['failed'][symbol] = '%s: %s' %(type(error).__name__,error)
+          metrics.incr('symbols_failed')
+        elif data is None or len(data) == 0:
+          report['empty'].append(symbol)
+          metrics.incr('symbols_empty')
+        else:
+          batch.append((symbol,data))
+      if not batch:
+        continue
+
+      try:
+        report['rows'] += _write_batch(cur,batch,symbol_dic,metrics)
+        stored = [symbol for symbol,data in batch]
+      except Exception as e:
+        # write the symbols one by one so that a single bad frame does not lose the batch
+        metrics.error(e,batch=len(batch))
+        stored = []
+        for symbol,data in batch:
+          try:
+            report['rows'] += _write_batch(cur,[(symbol,data)],symbol_dic,metrics)
+            stored.append(symbol)
+          except Exception as e:
+            metrics.error(e,symbol=symbol)
+            try:
+              # last resort: the row by row path of stock_database
+              stock_database.update_summary_table(symbol)
+              stock_database.update_data(_Quotes(symbol,data))
+              metrics.incr('row_by_row_fallback')
+              stored.append(symbol)
+            except Exception as e:
+              metrics.error(e,symbol=symbol)
+              metrics.incr('symbols_failed')
+              report['failed'][symbol] = '%s: %s' %(type(e).__name__,e)
+      checkpoint.add(stored)
+      report['stored'] += len(stored)
+      metrics.incr('symbols_stored',len(stored))
+      metrics.log('batch',symbols=stored)
+      print '%d symbols stored, %d failed' %(report['stored'],len(report['failed']))
+  except Exception as e:
+    metrics.error(e)
+    failure.append(sys.exc_info())
+    _drain(tasks)
+    while not finished and results.get() is not None:
+      pass
+  finally:
+    if db is not None:
+      db.close()
+
+def download(symbols,start,end=None,source=None,workers=8,rate=5.0,retries=3,backoff=1.0,
+             checkpoint=None,batch_size=50,flush_interval=5.0,queue_size=200,
+             metrics=None,run_log=None,profile=None,refresh=True):
+  """
+  Download the historical data of symbols from start to end (default: today) into the
+  database.
+
+  Parameters:
+      - source : object with a fetch(symbol,start,end) method returning a yahoo formatted
+                 dataframe. Default is YahooSource()
+      - workers : number of concurrent fetches
+      - rate : maximum number of requests per second over all the workers (0: no limit)
+      - retries, backoff : number of retries of a failed fetch and initial delay (seconds)
+                           of the exponential backoff between them
+      - checkpoint : path of the checkpoint file. Symbols listed there are skipped, and the
+                     symbols stored during the run are appended to it
+      - batch_size, flush_interval : the writer commits every batch_size symbols or every
+                                     flush_interval seconds
+      - queue_size : maximum number of downloaded frames waiting for the writer
+      - metrics : stock_metrics.RunMetrics collecting the run metrics (default: a new one)
+      - run_log : path of the JSONL run log, when metrics is not given
+      - profile : path where the merged cProfile statistics of all the threads are dumped
+      - refresh : refresh the stale rows of the METRICS table once the data is stored
+
+  Returns a report {'stored','rows','skipped','empty','failed' - {symbol - error},
+  'refreshed' - number of symbols whose metrics were refreshed, 'metrics' - summary of
+  the run metrics}
+  """
+  if end is None:
+    end = datetime.date.today()
+  if source is None:
+    source = YahooSource()
+  own_metrics = metrics is None
+  if own_metrics:
+    metrics = stock_metrics.RunMetrics(run_log)
+  profiler = stock_metrics.Profiler() if profile else None
+  checkpoint = Checkpoint(checkpoint)
+  todo = [symbol for symbol in symbols if symbol not in checkpoint]
+  report = {'stored':0,'rows':0,'skipped':len(symbols)-len(todo),'empty':[],'failed':{},'refreshed':0}
+  metrics.log('download',symbols=len(todo),skipped=report['skipped'],start=start,end=end)
+  print '%d symbols to download (%d already done)' %(len(todo),report['skipped'])
+
+  tasks = Queue.Queue()
+  for symbol in todo:
+    tasks.put(symbol)
+  results = Queue.Queue(queue_size)
+  limiter = RateLimiter(rate,burst=max(1,workers))
+  worker,writer_loop = _worker,_writer
+  if profiler is not None:
+    worker,writer_loop = profiler.wrap(_worker),profiler.wrap(_writer)
+
+  failure = []
+  writer = threading.Thread(target=writer_loop,args=(tasks,results,checkpoint,report,batch_size,flush_interval,metrics,failure))
+  writer.daemon = True
+  writer.start()
+  threads = []
+  for i in xrange(min(workers,len(todo))):
+    thread = threading.Thread(target=worker,args=(tasks,results,source,start,end,limiter,retries,backoff,metrics))
+    thread.daemon = True
+    thread.start()
+    threads.append(thread)
+  for thread in threads:
+    while thread.is_alive():
+      thread.join(0.5)
+  results.put(None)
+  while writer.is_alive():
+    writer.join(0.5)
+  if failure:
+    if profiler is not None:
+      profiler.dump(profile)
+    if own_metrics:
+      metrics.close()
+    raise failure[0][0],failure[0][1],failure[0][2]
+  if refresh and report['rows']:
+    with metrics.timer('refresh_metrics'):
+      report['refreshed'] = stock_screener.refresh_metrics()
+    metrics.incr('metrics_refreshed',report['refreshed'])
+
+  if profiler is not None:
+    profiler.dump(profile)
+  report['metrics'] = metrics.close() if own_metrics else metrics.summary()
+  stock_metrics.print_summary(report['metrics'])
+  return report
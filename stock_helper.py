@@ -5,6 +5,10 @@
 #################################################################
 
 import os
+import re
+import csv
+import bisect
+import cPickle
 import datetime
 import numpy as np
 import pandas as pd
@@ -29,30 +33,152 @@ def check_date_format(check_date):
   finally:
     return date, check
 
-def load_symbol_dic():
+SYMBOL_DIRECTORY = '/home/gilles/projects/trading/quant_trading/symbols'
+SYMBOL_CACHE = '.symbol_dic.pkl'
+_SYMBOL_DIC = {}     # directory - dictionary, parsed once per process
+
+def _read_symbol_file(path,dic):
+  """
+  Add the symbols of one exchange csv (nasdaq.com format) to dic. The first exchange
+  listing a symbol wins
+  """
+  with open(path,'rb') as f:
+    reader = csv.reader(f)
+    next(reader,None)   # header
+    for info in reader:
+      if len(info) < 8 or not info[0] or info[0] in dic:
+        continue
+      if 'n/a' in info[6]:
+        if 'ETF' in info[1]:
+          stock_type = 'ETF'
+        elif 'fund' in info[1].lower():
+          stock_type = 'Fund'
+        else:
+          stock_type = 'unknown'
+        dic[info[0]] = (info[1].lower(),stock_type,'n/a','n/a')
+      else:
+        dic[info[0]] = (info[1].lower(),'stock',info[6],info[7])
+
+def load_symbol_dic(directory=None):
   """
   Load a dictionary of all tickers symbols in the NSYE, NASDAQ and AMEX stock
   markets. {keys - values}  ==  {symbol - (company name,stock_type,sector,activity)}
+  The csv files of directory (default: SYMBOL_DIRECTORY) are parsed once per process
+  (the same dictionary is returned to every caller, do not modify it), and the result
+  is cached on disk next to them until one of the csv files changes.
   """
-  directory = '/home/gilles/projects/trading/quant_trading/symbols'
-  dic = {}
-  for item in os.listdir(directory):
-    with open(directory+'/'+item) as f:
-      for line in f:
-        if line.split(',')[0].replace('\"','') not in dic:
-          info = line.split(',')
-          if 'n/a' in info[6]:
-            if 'ETF' in info[1]:
-              stock_type = 'ETF'
-            elif 'fund' in info[1].lower():
-              stock_type = 'Fund'
-            else:
-              stock_type = 'unknown'
-            dic[info[0].replace('\"','')] = (info[1].replace('\"','').lower(),stock_type,'n/a','n/a')
-          else:
-            dic[info[0].replace('\"','')] = (info[1].replace('\"','').lower(),'stock',info[7],info[8])
+  if directory is None:
+    directory = SYMBOL_DIRECTORY
+  if directory in _SYMBOL_DIC:
+    return _SYMBOL_DIC[directory]
+  files = sorted(item for item in os.listdir(directory) if item.lower().endswith('.csv'))
+  stamp = [(item,os.path.getmtime(os.path.join(directory,item))) for item in files]
+  cache = os.path.join(directory,SYMBOL_CACHE)
+
+  dic = None
+  try:
+    with open(cache,'rb') as f:
+      cached_stamp,cached_dic = cPickle.load(f)
+    if cached_stamp == stamp:
+      dic = cached_dic
+  except (IOError,EOFError,ValueError,cPickle.UnpicklingError):
+    pass
+
+  if dic is None:
+    dic = {}
+    for item in files:
+      _read_symbol_file(os.path.join(directory,item),dic)
+    try:
+      with open(cache+'.tmp','wb') as f:
+        cPickle.dump((stamp,dic),f,cPickle.HIGHEST_PROTOCOL)
+      os.rename(cache+'.tmp',cache)
+    except (IOError,OSError):
+      pass
+  _SYMBOL_DIC[directory] = dic
   return dic
 
+def _name_tokens(name):
+  return re.findall(r'[a-z0-9]+',name.lower())
+
+class SymbolIndex:
+  """
+  Search index over the company names of a symbol dictionary. Candidates are ranked
+  exact match first, then names starting with the query, then names containing all the
+  words of the query (the last one possibly incomplete), then any substring match.
+  Within each group, shorter names come first
+  """
+  def __init__(self,dic):
+    self._dic = dic
+    self._exact = {}      # name - [symbols]
+    self._names = []      # sorted (name, symbol)
+    self._tokens = {}     # word - set(symbols)
+    for symbol,info in dic.iteritems():
+      self._exact.setdefault(info[0],[]).append(symbol)
+      self._names.append((info[0],symbol))
+      for token in _name_tokens(info[0]):
+        self._tokens.setdefault(token,set()).add(symbol)
+    self._names.sort()
+    self._words = sorted(self._tokens)
+
+  def _prefixed(self,items,prefix):
+    """
+    Entries of the sorted list items starting with prefix (binary search)
+    """
+    i = bisect.bisect_left(items,prefix)
+    found = []
+    while i < len(items) and (items[i][0] if isinstance(items[i],tuple) else items[i]).startswith(prefix):
+      found.append(items[i])
+      i += 1
+    return found
+
+  def search(self,name,limit=10):
+    """
+    Return up to limit candidates (symbol, company name, match) for a company name,
+    match being 'exact', 'prefix', 'token' or 'substring'
+    """
+    query = name.strip().lower()
+    results = []
+    seen = set()
+    def add(symbols,match):
+      for symbol in sorted(symbols,key=lambda item: (len(self._dic[item][0]),item)):
+        if symbol not in seen:
+          seen.add(symbol)
+          results.append((symbol,self._dic[symbol][0],match))
+
+    add(self._exact.get(query,[]),'exact')
+    add([symbol for company_name,symbol in self._prefixed(self._names,(query,))],'prefix')
+    tokens = _name_tokens(query)
+    if tokens and len(results) < limit:
+      last = set()
+      for word in self._prefixed(self._words,tokens[-1]):
+        last |= self._tokens[word]
+      matches = [self._tokens.get(token,set()) for token in tokens[:-1]]+[last]
+      add(set.intersection(*matches),'token')
+    if not results and query:
+      add([symbol for company_name,symbol in self._names if query in company_name],'substring')
+    return results[:limit]
+
+  def lookup(self,name):
+    """
+    Symbol whose company name is exactly name (None if there is none)
+    """
+    symbols = self._exact.get(name.strip().lower())
+    if symbols:
+      return sorted(symbols)[0]
+    return None
+
+_SYMBOL_INDEX = {}
+
+def load_symbol_index(directory=None):
+  """
+  Company name index over load_symbol_dic, built once per process
+  """
+  if directory is None:
+    directory = SYMBOL_DIRECTORY
+  if directory not in _SYMBOL_INDEX:
+    _SYMBOL_INDEX[directory] = SymbolIndex(load_symbol_dic(directory))
+  return _SYMBOL_INDEX[directory]
+
 def ADF_test(series,lag):
   """
   Outputs the result of the Augmented Dickey-Fuller test for the series.
@@ -87,16 +213,60 @@ def get_hurst(series,lag):
   - if H < 0.5 and H --> 0 : the series is mean reverting
   - if H < 0, white noise
   """
-  lag = min(lag,len(series))-1
-  lags = range(2,lag)
+  values = _adj_close(series)
+  values = values[~np.isnan(values)]
+  return get_hurst_batch(values[:,np.newaxis],lag)[0]
 
-  #Calculate the array of the variances of the lagged differences
-  tau = [np.sqrt(np.std(np.subtract(series[item:]['Adj Close'],series[:-item]['Adj Close']))) for item in lags]
-  #Use linear fit to estimate the Hurst Exponent
-  poly = np.polyfit(np.log(lags), np.log(tau),1)
-  H = poly[0]*2.0
+def get_hurst_batch(panel,lag):
+  """
+  Hurst exponent of every column of a 2-D price panel (one column per symbol) in one
+  call, same estimate as get_hurst: the missing prices of each column are dropped, and
+  the columns left with the same number of prices are computed together.
+  A dataframe panel gives a Series indexed by symbol
+  """
+  values = _adj_close(panel)
+  valid = ~np.isnan(values)
+  counts = valid.sum(axis=0)
+  H = np.empty(values.shape[1])
+  H.fill(np.nan)
+  for n in np.unique(counts):
+    columns = np.flatnonzero(counts == n)
+    #Prices of the columns without their NaN, column by column
+    prices = values[:,columns].T[valid[:,columns].T].reshape(len(columns),n).T
+    lags = np.arange(2,min(lag,n)-1)
+    if len(lags) < 2:
+      continue
+    #Calculate the array of the variances of the lagged differences
+    tau = np.sqrt(_lagged_std(prices,lags))
+    #Use linear fit to estimate the Hurst Exponent
+    with np.errstate(divide='ignore',invalid='ignore'):
+      poly = np.polyfit(np.log(lags),np.log(tau),1)
+    H[columns] = poly[0]*2.0
+  if isinstance(panel,pd.DataFrame):
+    return pd.Series(H,index=panel.columns)
   return H
 
+def _lagged_std(values,lags):
+  """
+  Standard deviation of values[lag:]-values[:-lag] for every lag and every column of the
+  2-D array values, without building the lagged differences: the sums of the
+  differences come from cumulative sums, and their sums of squares from the
+  autocorrelation of each column computed with one FFT
+  """
+  n = len(values)
+  x = values-values.mean(axis=0)
+  zero = np.zeros((1,x.shape[1]))
+  s1 = np.concatenate((zero,np.cumsum(x,axis=0)))
+  s2 = np.concatenate((zero,np.cumsum(x*x,axis=0)))
+  size = 1 << int(np.ceil(np.log2(2*n)))
+  spectrum = np.fft.rfft(x,size,axis=0)
+  autocorr = np.fft.irfft(spectrum*np.conj(spectrum),size,axis=0)[:n]
+
+  m = (n-lags)[:,np.newaxis].astype(np.float64)
+  total = (s1[n]-s1[lags])-s1[n-lags]
+  squares = (s2[n]-s2[lags])+s2[n-lags]-2*autocorr[lags]
+  return np.sqrt(np.maximum(squares/m-(total/m)**2,0))
+
 def variance_ratio_test(series,lag):
   """The ouputs are h and the p-value. h > 1 means the random walk hypothesis should be
      rejected, h < -1 it should be accepted. The closer to 0, the closer to a random
@@ -106,6 +276,75 @@ def variance_ratio_test(series,lag):
   VR = arch.unitroot.VarianceRatio(series['Adj Close'],lag)
   return (VR.stat,VR.pvalue)
 
+def _adj_close(series):
+  """
+  Adjusted close prices of a yahoo dataframe, or values of any series, panel or array,
+  as a float array
+  """
+  if isinstance(series,pd.DataFrame) and 'Adj Close' in series.columns:
+    series = series['Adj Close']
+  return np.asarray(series,dtype=np.float64)
+
+def daily_returns(prices):
+  """
+  Simple returns of a price series (1-D) or of a panel of prices (2-D, one column per
+  symbol). A missing price (NaN) gives a missing return
+  """
+  prices = np.asarray(prices,dtype=np.float64)
+  return prices[1:]/prices[:-1]-1
+
+def returns_sharpe(returns,risk_free=0.04,periods=252):
+  """
+  Annualized Sharpe ratio of each column of returns (or of a 1-D series of returns),
+  risk_free being the annual risk-free rate and periods the number of periods per year.
+  Missing returns are ignored
+  """
+  returns = np.asarray(returns,dtype=np.float64)
+  excess = returns-float(risk_free)/periods
+  with np.errstate(invalid='ignore',divide='ignore'):
+    return np.sqrt(periods)*np.nanmean(excess,axis=0)/np.nanstd(excess,axis=0)
+
+def sharpe_ratio(prices,risk_free=0.04,periods=252):
+  """
+  Annualized Sharpe ratio from prices, for a single series or for every column of a
+  date-aligned panel in one vectorized pass (a dataframe panel gives a Series indexed
+  by symbol). Default: 4% annual risk-free rate, and 252 trading days a year
+  """
+  Sharpe = returns_sharpe(daily_returns(prices),risk_free,periods)
+  if isinstance(prices,pd.DataFrame):
+    return pd.Series(Sharpe,index=prices.columns)
+  return Sharpe
+
+OHLCV_AGGREGATION = [('Open','first'),('High','max'),('Low','min'),('Close','last'),
+                     ('Volume','sum'),('Adj Close','last')]
+
+def _period_keys(index,freq):
+  """
+  Integer key of the week (Monday to Sunday, freq='W') or of the month (freq='M') of
+  each date of index
+  """
+  days = pd.DatetimeIndex(index).values.astype('datetime64[D]').astype(np.int64)
+  if freq == 'W':
+    return (days+3)//7            # 1970-01-01 was a Thursday
+  if freq == 'M':
+    return pd.DatetimeIndex(index).values.astype('datetime64[M]').astype(np.int64)
+  raise ValueError('unknown frequency %s, use "W" or "M"' %freq)
+
+def resample_ohlcv(data,freq):
+  """
+  Weekly (freq='W') or monthly (freq='M') bars from a daily yahoo dataframe: first open,
+  highest high, lowest low, last close and adjusted close, total volume. Each bar is
+  dated by its last trading day. Columns other than OHLCV are dropped
+  """
+  keys = _period_keys(data.index,freq)
+  columns = [(column,how) for column,how in OHLCV_AGGREGATION if column in data.columns]
+  grouped = data[[column for column,how in columns]].groupby(keys)
+  bars = pd.DataFrame(dict((column,getattr(grouped[column],how)()) for column,how in columns),
+                      columns=[column for column,how in columns])
+  dates = pd.Series(pd.DatetimeIndex(data.index).values).groupby(keys).max()
+  bars.index = pd.DatetimeIndex(dates.values,name=data.index.name)
+  return bars
+
 def cadf(s1,s2):
   """
   Cointegrated Augmented Dickey-Fuller test
@@ -123,5 +362,37 @@ def cadf(s1,s2):
   return ts.adfuller(residual), beta_hr
 
 def momentum_autocorrelation(series,max_lag):
-  """ calculate the """
-  return
\ No newline at end of file
+  """
+  Autocorrelation of the daily returns of the series for every lag from 1 to max_lag,
+  all computed at once with an FFT in O(n log n).
+  Returns (autocorrelations, band): autocorrelations above band (95% significance band,
+  1.96/sqrt(n)) indicate momentum at that lag, below -band mean reversion
+  """
+  values = _adj_close(series)
+  values = values[~np.isnan(values)]
+  autocorr,band = momentum_autocorrelation_batch(values[:,np.newaxis],max_lag)
+  return autocorr[:,0],band[0]
+
+def momentum_autocorrelation_batch(panel,max_lag):
+  """
+  Return autocorrelations of every column of a 2-D price panel in one batch of FFTs.
+  Missing returns (e.g. before a listing) do not contribute to the sums.
+  Returns (autocorrelations of shape max_lag x columns, significance band per column).
+  A dataframe panel gives a dataframe indexed by lag and a Series indexed by symbol
+  """
+  returns = daily_returns(_adj_close(panel))
+  valid = ~np.isnan(returns)
+  n = valid.sum(axis=0)
+  with np.errstate(invalid='ignore',divide='ignore'):
+    x = np.where(valid,returns-np.nanmean(returns,axis=0),0.)
+    # zero padding of at least max_lag: no circular wrap-around up to max_lag
+    size = 1 << int(np.ceil(np.log2(max(len(x)+max_lag,2))))
+    spectrum = np.fft.rfft(x,size,axis=0)
+    autocov = np.fft.irfft(spectrum*np.conj(spectrum),size,axis=0)[:max_lag+1]
+    autocorr = autocov[1:]/autocov[0]
+    band = 1.96/np.sqrt(n)
+  autocorr[:,n <= max_lag] = np.nan
+  if isinstance(panel,pd.DataFrame):
+    return (pd.DataFrame(autocorr,index=pd.Index(np.arange(1,max_lag+1),name='lag'),columns=panel.columns),
+            pd.Series(band,index=panel.columns))
+  return autocorr,band
\ No newline at end of file
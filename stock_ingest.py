@@ -0,0 +1,192 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import stock_helper
+import stock_database
+import stock_metrics
+
+"""
+Offline bulk import of end-of-day CSV dumps into the market database.
+
+Files are streamed chunksize rows at a time, so memory stays bounded whatever their size.
+A file has one row per (symbol, date) with the open, high, low, close and volume (the
+adjusted close is optional, the close is used when it is missing). A file without a
+symbol column holds a single symbol named after the file, like a yahoo csv quote.
+Rows are validated, de-duplicated on (symbol, date) and written through
+stock_database.write_historical, one transaction per chunk. The derived tables are built
+once at the end instead of at every chunk.
+
+Usage: python stock_database.py ingest dump1.csv dump2.csv [--chunksize 200000]
+"""
+
+COLUMN_ALIASES = {'symbol':'symbol','ticker':'symbol','date':'date','timestamp':'date',
+                  'open':'Open','high':'High','low':'Low','close':'Close','volume':'Volume',
+                  'adj close':'Adj Close','adj_close':'Adj Close','adjclose':'Adj Close',
+                  'adjusted close':'Adj Close','adjusted_close':'Adj Close'}
+PRICE_COLUMNS = ['Open','High','Low','Close']
+
+def _column_map(path):
+  """
+  Columns of the csv file mapped to the names used here ({file column - name}), from its
+  header only
+  """
+  header = pd.read_csv(path,nrows=0).columns
+  mapping = {}
+  for column in header:
+    name = COLUMN_ALIASES.get(str(column).strip().lower())
+    if name is not None and name not in mapping.values():
+      mapping[column] = name
+  missing = set(['date','Volume']+PRICE_COLUMNS)-set(mapping.values())
+  if missing:
+    raise ValueError('%s: missing columns %s' %(path,', '.join(sorted(missing))))
+  return mapping
+
+def clean_chunk(chunk,date_format=None):
+  """
+  Validate the rows of a chunk (renamed columns, with a symbol column) in vectorized
+  passes: parse the dates and numbers, reject the rows with a missing or non-positive
+  price, a negative volume or inconsistent high/low, then drop the repeated
+  (symbol, date) keys (the first one is kept, like the INSERT OR IGNORE of the database).
+  Returns (clean dataframe sorted by symbol and date, {reason - rows rejected})
+  """
+  rejected = {}
+  def count(reason,bad):
+    if bad.any():
+      rejected[reason] = rejected.get(reason,0)+int(bad.sum())
+    return bad
+
+  dates = chunk['date']
+  if dates.dtype.kind in 'iu':
+    dates = dates.astype(str)          # YYYYMMDD integers
+  chunk['date'] = pd.to_datetime(dates,format=date_format,errors='coerce')
+  missing_symbol = chunk['symbol'].isnull().values
+  chunk['symbol'] = chunk['symbol'].astype(str).str.strip()
+  for column in PRICE_COLUMNS+['Volume','Adj Close']:
+    chunk[column] = pd.to_numeric(chunk[column],errors='coerce')
+  chunk['Adj Close'] = chunk['Adj Close'].fillna(chunk['Close'])
+
+  prices = chunk[PRICE_COLUMNS].values
+  open_,high,low,close = prices.T
+  volume = chunk['Volume'].values
+  with np.errstate(invalid='ignore'):
+    bad = count('bad date',chunk['date'].isnull().values)
+    bad = bad | count('bad symbol',~bad & (missing_symbol | (chunk['symbol'] == '').values))
+    bad = bad | count('bad price',~bad & (np.isnan(prices).any(axis=1) | (prices <= 0).any(axis=1)))
+    bad = bad | count('bad volume',~bad & (np.isnan(volume) | (volume < 0)))
+    bad = bad | count('high/low',~bad & ((high < np.maximum(open_,close)) | (low > np.minimum(open_,close))))
+  chunk = chunk[~bad]
+  chunk = chunk[~count('duplicate',chunk.duplicated(['symbol','date']).values)]
+  return chunk.sort_values(['symbol','date']),rejected
+
+def _symbol_info():
+  """
+  Symbol dictionary for the SUMMARY entries (empty if the symbol files are not there)
+  """
+  try:
+    return stock_helper.load_symbol_dic()
+  except (IOError,OSError):
+    return {}
+
+def _write_chunk(cur,chunk,symbol_dic,known):
+  """
+  Write the rows of a clean chunk, symbol by symbol (no commit).
+  Returns (rows inserted, rows already in the database, symbols written)
+  """
+  if not len(chunk):
+    return 0,0,set()
+  inserted = skipped = 0
+  symbols = chunk['symbol'].values
+  bounds = np.flatnonzero(symbols[1:] != symbols[:-1])+1
+  starts = np.concatenate(([0],bounds))
+  ends = np.concatenate((bounds,[len(symbols)]))
+  for start,end in zip(starts,ends):
+    symbol = symbols[start]
+    if symbol not in known:
+      if symbol in symbol_dic:
+        stock_database.write_summary(cur,symbol,symbol_dic)
+      else:
+        cur.execute('INSERT OR IGNORE INTO SUMMARY(Symbol,Name,Type,Sector,Industry) VALUES(?,?,?,?,?)',(symbol,symbol,'n/a','n/a','n/a'))
+      known.add(symbol)
+    rows = chunk.iloc[start:end]
+    data = pd.DataFrame(dict((column,rows[column].values) for column in stock_database.HISTORICAL_COLUMNS),
+                        index=pd.DatetimeIndex(rows['date'].values),columns=stock_database.HISTORICAL_COLUMNS)
+    counts = stock_database.write_historical(cur,symbol,data,derived=False)
+    inserted += counts[0]
+    skipped += counts[1]
+  return inserted,skipped,set(symbols[starts])
+
+def ingest_csv(paths,chunksize=200000,date_format=None,derived=True,metrics=None,run_log=None):
+  """
+  Import csv files into the database.
+
+  Parameters:
+      - paths : csv file or list of csv files
+      - chunksize : number of rows read, validated and written at a time
+      - date_format : strptime format of the dates (default: inferred, YYYYMMDD integers
+                      are accepted)
+      - derived : build the derived tables (returns, weekly/monthly bars) of the symbols
+                  written, once at the end
+      - metrics : stock_metrics.RunMetrics collecting the run metrics (default: a new one)
+      - run_log : path of the JSONL run log, when metrics is not given
+
+  Returns a report {'files','rows_read','inserted','skipped','rejected' - {reason - rows},
+  'symbols','seconds','rows_per_s','mb_per_s','metrics' - summary of the run metrics}
+  """
+  if isinstance(paths,basestring):
+    paths = [paths]
+  own_metrics = metrics is None
+  if own_metrics:
+    metrics = stock_metrics.RunMetrics(run_log)
+  started = time.time()
+  report = {'files':len(paths),'rows_read':0,'inserted':0,'skipped':0,'rejected':{}}
+  symbol_dic = _symbol_info()
+  known = set()
+  written = set()
+  with stock_database.transaction() as cur:
+    cur.execute('CREATE TABLE IF NOT EXISTS SUMMARY(Symbol TEXT PRIMARY KEY, Name TEXT, Type TEXT, Sector TEXT, Industry TEXT)')
+
+  for path in paths:
+    mapping = _column_map(path)
+    default_symbol = os.path.splitext(os.path.basename(path))[0]
+    metrics.log('file',path=path,bytes=os.path.getsize(path))
+    reader = pd.read_csv(path,usecols=list(mapping),chunksize=chunksize,dtype=dict((column,str) for column,name in mapping.items() if name == 'symbol'))
+    for chunk in reader:
+      with metrics.timer('parse'):
+        chunk = chunk.rename(columns=mapping)
+        if 'symbol' not in chunk.columns:
+          chunk['symbol'] = default_symbol
+        if 'Adj Close' not in chunk.columns:
+          chunk['Adj Close'] = np.nan
+        report['rows_read'] += len(chunk)
+        chunk,rejected = clean_chunk(chunk,date_format)
+      for reason,count in rejected.items():
+        report['rejected'][reason] = report['rejected'].get(reason,0)+count
+        metrics.incr('rejected '+reason,count)
+      with metrics.timer('write'):
+        with stock_database.transaction() as cur:
+          inserted,skipped,symbols = _write_chunk(cur,chunk,symbol_dic,known)
+        stock_database.data_changed(symbols)
+      written |= symbols
+      report['inserted'] += inserted
+      report['skipped'] += skipped
+      metrics.incr('rows_inserted',inserted)
+      metrics.incr('rows_skipped',skipped)
+      print '%s: %d rows read, %d inserted, %.0f rows/s' %(os.path.basename(path),report['rows_read'],
+            report['inserted'],report['rows_read']/max(time.time()-started,1e-9))
+
+  if derived and written:
+    with metrics.timer('backfill'):
+      stock_database.backfill_derived(sorted(written))
+  seconds = time.time()-started
+  size = sum(os.path.getsize(path) for path in paths)
+  report.update({'symbols':len(written),'seconds':seconds,
+                 'rows_per_s':report['rows_read']/seconds if seconds > 0 else 0.,
+                 'mb_per_s':size/1e6/seconds if seconds > 0 else 0.})
+  report['metrics'] = metrics.close() if own_metrics else metrics.summary()
+  print '%d files, %d rows read in %.1fs (%.0f rows/s, %.1f MB/s): %d inserted, %d already stored, %d rejected, %d symbols' %(
+        len(paths),report['rows_read'],seconds,report['rows_per_s'],report['mb_per_s'],report['inserted'],
+        report['skipped'],sum(report['rejected'].values()),len(written))
+  for reason,count in sorted(report['rejected'].items()):
+    print '  rejected (%s): %d' %(reason,count)
+  return report
@@ -0,0 +1,152 @@
+import time
+import json
+import pstats
+import cProfile
+import threading
+import contextlib
+import numpy as np
+
+"""
+Instrumentation of the ingestion pipeline.
+
+RunMetrics collects counters, timings (e.g. fetch latency per symbol, sqlite lock wait and
+commit time) and error counts by exception type during a run. It is thread-safe, can write
+every event to a JSONL run log, and summarizes the run (wall time, rows inserted per
+second, latency percentiles...). Profiler runs functions under cProfile in any thread and
+merges the profiles of all the threads.
+"""
+
+class RunMetrics:
+  """
+  Metrics of one run. If log_path is given, every event is appended to it as a JSON line
+  """
+  def __init__(self,log_path=None):
+    self._lock = threading.Lock()
+    self._start = time.time()
+    self._counters = {}
+    self._timings = {}        # name - list of durations (seconds)
+    self._errors = {}         # exception type - count
+    self._log = open(log_path,'a') if log_path else None
+    self.log('run_start')
+
+  def log(self,event,**fields):
+    """
+    Append an event to the run log
+    """
+    if self._log is None:
+      return
+    fields['event'] = event
+    fields['time'] = time.time()
+    line = json.dumps(fields,default=str)
+    with self._lock:
+      self._log.write(line+'\n')
+      self._log.flush()
+
+  def incr(self,name,value=1):
+    with self._lock:
+      self._counters[name] = self._counters.get(name,0)+value
+
+  def observe(self,name,seconds,**fields):
+    """
+    Record a duration. Fields (e.g. the symbol) only go to the run log
+    """
+    with self._lock:
+      self._timings.setdefault(name,[]).append(seconds)
+    if fields:
+      fields['seconds'] = seconds
+      self.log(name,**fields)
+
+  @contextlib.contextmanager
+  def timer(self,name,**fields):
+    """
+    with metrics.timer('commit'): ... records the duration of the block
+    """
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.observe(name,time.time()-start,**fields)
+
+  def error(self,exception,**fields):
+    """
+    Count an exception by type and log it
+    """
+    name = type(exception).__name__
+    with self._lock:
+      self._errors[name] = self._errors.get(name,0)+1
+    self.log('error',type=name,message=str(exception),**fields)
+
+  def counter(self,name):
+    return self._counters.get(name,0)
+
+  def summary(self):
+    """
+    Dictionary with the wall time, counters, timing statistics (count, total, mean, p50,
+    p95, max) and error counts of the run
+    """
+    with self._lock:
+      wall = time.time()-self._start
+      timings = {}
+      for name,values in self._timings.iteritems():
+        values = np.array(values)
+        timings[name] = {'count':len(values),'total':values.sum(),'mean':values.mean(),
+                         'p50':np.percentile(values,50),'p95':np.percentile(values,95),
+                         'max':values.max()}
+      return {'wall_time':wall,
+              'counters':dict(self._counters),
+              'rows_per_s':self._counters.get('rows_inserted',0)/wall if wall > 0 else 0.,
+              'timings':timings,
+              'errors':dict(self._errors)}
+
+  def close(self):
+    """
+    Log the summary and close the run log. Returns the summary
+    """
+    summary = self.summary()
+    self.log('run_end',**summary)
+    if self._log is not None:
+      self._log.close()
+      self._log = None
+    return summary
+
+def print_summary(summary):
+  print 'wall time %.1fs, %.0f rows inserted/s' %(summary['wall_time'],summary['rows_per_s'])
+  for name,value in sorted(summary['counters'].items()):
+    print '  %-20s %d' %(name,value)
+  for name,timing in sorted(summary['timings'].items()):
+    print '  %-20s n=%d total=%.2fs mean=%.4fs p95=%.4fs max=%.4fs' %(name,timing['count'],
+          timing['total'],timing['mean'],timing['p95'],timing['max'])
+  for name,count in sorted(summary['errors'].items()):
+    print '  error %-14s %d' %(name,count)
+
+class Profiler:
+  """
+  cProfile hook working across threads: wrap() the function run by each thread, then
+  dump() the merged statistics
+  """
+  def __init__(self):
+    self._profiles = []
+    self._lock = threading.Lock()
+
+  def wrap(self,func):
+    def profiled(*args,**kwargs):
+      profile = cProfile.Profile()
+      try:
+        return profile.runcall(func,*args,**kwargs)
+      finally:
+        with self._lock:
+          self._profiles.append(profile)
+    return profiled
+
+  def stats(self):
+    if not self._profiles:
+      return None
+    stats = pstats.Stats(self._profiles[0])
+    for profile in self._profiles[1:]:
+      stats.add(profile)
+    return stats
+
+  def dump(self,path):
+    stats = self.stats()
+    if stats is not None:
+      stats.dump_stats(path)
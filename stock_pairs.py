@@ -0,0 +1,126 @@
+import multiprocessing
+import numpy as np
+import pandas as pd
+import stock_helper
+import stock_database
+import stock_panel
+
+"""
+Pairs trading screener: cointegration (stock_helper.cadf) of every pair of symbols within
+a sector (or a sector and industry) of the SUMMARY table.
+
+The pairs are first filtered on the correlation of their daily returns (one correlation
+matrix per group), then the remaining cadf tests run over a process pool. The results are
+written to the PAIRS table as they arrive, pairs already there are skipped, so an
+interrupted screening resumes where it stopped.
+"""
+
+RESULTS_TABLE = 'PAIRS'
+
+def candidate_groups(by='Sector'):
+  """
+  Symbols of the SUMMARY table grouped by sector (by='Sector') or by sector and
+  industry (by='Industry'). Groups of less than two symbols are left out
+  """
+  db,cur = stock_database.connection()
+  cur.execute('SELECT Symbol,Sector,Industry FROM SUMMARY WHERE Sector!="n/a"')
+  groups = {}
+  for symbol,sector,industry in cur.fetchall():
+    key = sector if by == 'Sector' else (sector,industry)
+    groups.setdefault(key,[]).append(symbol)
+  return dict((key,sorted(symbols)) for key,symbols in groups.iteritems() if len(symbols) > 1)
+
+def correlated_pairs(panel,threshold=0.8,min_periods=60):
+  """
+  Pairs of columns of a price panel whose daily returns have a correlation of at least
+  threshold. Returns a list of (column 1, column 2, correlation) with column 1 < column 2
+  """
+  corr = panel.pct_change().corr(min_periods=min_periods).values
+  first,second = np.triu_indices(len(corr),1)
+  keep = corr[first,second] >= threshold
+  return [(a,b,corr[a,b]) for a,b in zip(first[keep],second[keep])]
+
+def _create_results_table(cur):
+  cur.execute('CREATE TABLE IF NOT EXISTS %s(Symbol1 TEXT, Symbol2 TEXT, Correlation REAL, Statistic REAL, Pvalue REAL, Hedge_ratio REAL, Error TEXT, PRIMARY KEY(Symbol1,Symbol2))' %RESULTS_TABLE)
+
+_PANEL = None
+
+def _init_worker(panel):
+  """
+  Pool initializer: the panel of the group is handed to each worker once (inherited when
+  the workers are forked), the tasks only carry column numbers
+  """
+  global _PANEL
+  _PANEL = panel
+
+def _test_pair(task):
+  """
+  cadf test of two columns of the panel, on the dates where both have a price
+  """
+  a,b,correlation = task
+  both = ~(np.isnan(_PANEL[:,a]) | np.isnan(_PANEL[:,b]))
+  s1 = pd.DataFrame({'Adj Close':_PANEL[both,a]})
+  s2 = pd.DataFrame({'Adj Close':_PANEL[both,b]})
+  try:
+    adf,beta_hr = stock_helper.cadf(s1,s2)
+    return a,b,correlation,float(adf[0]),float(adf[1]),float(beta_hr),None
+  except Exception as e:
+    return a,b,correlation,None,None,None,'%s: %s' %(type(e).__name__,e)
+
+def screen_pairs(by='Sector',threshold=0.8,start=None,end=None,processes=None,commit_every=500):
+  """
+  Run the cointegration screening of all the pairs within each group of candidate_groups.
+
+  Parameters:
+      - by : 'Sector' or 'Industry' (pairs within the same sector and industry)
+      - threshold : minimum correlation of the daily returns for a pair to be tested
+      - start, end : period of the price data
+      - processes : size of the process pool (default: number of cores)
+      - commit_every : number of results written per transaction
+
+  Returns the number of pairs tested during this run
+  """
+  db,cur = stock_database.connection()
+  _create_results_table(cur)
+  db.commit()
+  cur.execute('SELECT Symbol1,Symbol2 FROM %s' %RESULTS_TABLE)
+  done = set(cur.fetchall())
+
+  tested = 0
+  for key,symbols in sorted(candidate_groups(by).items()):
+    panel = stock_panel.load_panel(symbols,start,end)
+    if panel.shape[1] < 2:
+      continue
+    columns = list(panel.columns)
+    tasks = [(a,b,c) for a,b,c in correlated_pairs(panel,threshold) if (columns[a],columns[b]) not in done]
+    print '%s: %d symbols, %d pairs to test' %(key,len(columns),len(tasks))
+    if not tasks:
+      continue
+
+    pool = multiprocessing.Pool(processes,_init_worker,(panel.values,))
+    try:
+      results = pool.imap_unordered(_test_pair,tasks,chunksize=16)
+      for i,(a,b,correlation,statistic,pvalue,beta_hr,error) in enumerate(results):
+        cur.execute('INSERT OR REPLACE INTO %s VALUES(?,?,?,?,?,?,?)' %RESULTS_TABLE,
+                    (columns[a],columns[b],correlation,statistic,pvalue,beta_hr,error))
+        if (i+1)%commit_every == 0:
+          db.commit()
+      db.commit()
+      pool.close()
+    except:
+      db.commit()
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+    tested += len(tasks)
+  return tested
+
+def cointegrated_pairs(pvalue=0.05):
+  """
+  Pairs of the results table with a cadf p-value below pvalue, most significant first
+  """
+  db,cur = stock_database.connection()
+  cur.execute('SELECT Symbol1,Symbol2,Correlation,Statistic,Pvalue,Hedge_ratio FROM %s WHERE Pvalue<? ORDER BY Pvalue' %RESULTS_TABLE,(pvalue,))
+  rows = cur.fetchall()
+  return pd.DataFrame(rows,columns=['Symbol1','Symbol2','Correlation','Statistic','Pvalue','Hedge_ratio'])
@@ -0,0 +1,198 @@
+import multiprocessing
+import multiprocessing.sharedctypes
+import numpy as np
+import pandas as pd
+import stock_helper
+import stock_database
+import stock_columnar
+
+"""
+Date-aligned panels of prices for many symbols: one row per date, one column per
+symbol, NaN where a symbol has no quote. The batch analytics of stock_helper work
+directly on these panels.
+
+A panel can also be built in shared memory (load_shared_panel), so that panel_map runs
+any per-symbol analytic of stock_helper over it on all the cores: the forked workers read
+the prices in place instead of receiving pickled dataframes or reopening the database.
+"""
+
+def load_panel(symbols,start=None,end=None,column='Adj Close',mode='disk'):
+  """
+  Load column for symbols between start and end into a dataframe indexed by the union
+  of their dates. Symbols missing from the database are left out.
+  mode is "disk" (sqlite database) or "columnar" (memory-mapped columnar store)
+  """
+  return _align(_load_series(symbols,start,end,column,mode))
+
+def _load_series(symbols,start,end,column,mode):
+  """
+  List of (symbol, dates, values) of the symbols found in the database
+  """
+  series = []
+  for symbol in symbols:
+    if mode == 'columnar':
+      data = stock_columnar.load_symbol(symbol,start,end,[column])
+    else:
+      data = stock_database.extract_series(symbol,start,end,[column],as_arrays=True)
+    if data is not None and len(data['date']):
+      series.append((symbol,data['date'],data[column]))
+  return series
+
+def load_returns_panel(symbols,start=None,end=None,log=False):
+  """
+  Panel of the precomputed daily returns (simple, or log with log=True) of symbols
+  between start and end, from the RETURNS table of stock_database
+  """
+  series = []
+  for symbol in symbols:
+    data = stock_database.extract_returns(symbol,start,end,log)
+    if data is not None and len(data['date']):
+      series.append((symbol,data['date'],data['return']))
+  return _align(series)
+
+def _align(series):
+  """
+  Dataframe indexed by the union of the dates of a list of (symbol, dates, values)
+  """
+  if not series:
+    return pd.DataFrame()
+
+  dates = np.unique(np.concatenate([item[1] for item in series]))
+  values = np.empty((len(dates),len(series)))
+  _fill(values,dates,series)
+  return pd.DataFrame(values,index=pd.DatetimeIndex(dates,name='date'),
+                      columns=[item[0] for item in series])
+
+def _fill(values,dates,series):
+  """
+  Write each (symbol, dates, values) of series into its column of values, NaN elsewhere
+  """
+  values.fill(np.nan)
+  for j,(symbol,index,value) in enumerate(series):
+    values[np.searchsorted(dates,index),j] = value
+
+def universe_sharpe(symbols,start=None,end=None,risk_free=0.04,periods=252,precomputed=False):
+  """
+  Annualized Sharpe ratio of every symbol between start and end, computed in one pass
+  over the adjusted close panel, or over the precomputed returns with precomputed=True.
+  Returns a Series sorted from best to worst
+  """
+  if precomputed:
+    returns = load_returns_panel(symbols,start,end)
+    Sharpe = pd.Series(stock_helper.returns_sharpe(returns.values,risk_free,periods),index=returns.columns)
+  else:
+    Sharpe = stock_helper.sharpe_ratio(load_panel(symbols,start,end),risk_free,periods)
+  return Sharpe.sort_values(ascending=False)
+
+def momentum_scan(symbols,start=None,end=None,max_lag=20):
+  """
+  Return autocorrelations of every symbol for the lags 1 to max_lag, in one batch over
+  the adjusted close panel. Returns a dataframe (one row per symbol) with the lag 1
+  autocorrelation and the number of lags significantly above (momentum) and below (mean
+  reversion) the 95% band, strongest momentum first
+  """
+  autocorr,band = stock_helper.momentum_autocorrelation_batch(load_panel(symbols,start,end),max_lag)
+  scan = pd.DataFrame({'lag1':autocorr.iloc[0],
+                       'momentum_lags':(autocorr > band).sum(),
+                       'reversion_lags':(autocorr < -band).sum(),
+                       'band':band},columns=['lag1','momentum_lags','reversion_lags','band'])
+  return scan.sort_values(['momentum_lags','lag1'],ascending=False)
+
+class SharedPanel:
+  """
+  Date-aligned float panel (dates x symbols) in shared memory, with its symbol - column
+  index. Processes forked after it is built see the same memory, without any copy
+  """
+  def __init__(self,dates,symbols):
+    self.dates = np.asarray(dates,dtype='datetime64[D]')
+    self.symbols = list(symbols)
+    self.index = dict((symbol,j) for j,symbol in enumerate(self.symbols))
+    self._shape = (len(self.dates),len(self.symbols))
+    self._buffer = multiprocessing.sharedctypes.RawArray('d',max(1,self._shape[0]*self._shape[1]))
+
+  def __len__(self):
+    return len(self.symbols)
+
+  def values(self):
+    """
+    2-D array view of the shared memory
+    """
+    return np.frombuffer(self._buffer,dtype=np.float64,count=self._shape[0]*self._shape[1]).reshape(self._shape)
+
+  def column(self,symbol):
+    """
+    Prices of symbol (view of its column, NaN where it has no quote)
+    """
+    return self.values()[:,self.index[symbol]]
+
+  def series(self,symbol):
+    """
+    Yahoo-style dataframe {'Adj Close'} of symbol without its missing days, the input
+    of the stock_helper analytics
+    """
+    values = self.column(symbol)
+    valid = ~np.isnan(values)
+    return pd.DataFrame({'Adj Close':values[valid]},index=pd.DatetimeIndex(self.dates[valid],name='date'))
+
+  def frame(self):
+    """
+    Dataframe over the shared memory (no copy)
+    """
+    return pd.DataFrame(self.values(),index=pd.DatetimeIndex(self.dates,name='date'),columns=self.symbols)
+
+def load_shared_panel(symbols,start=None,end=None,column='Adj Close',mode='disk'):
+  """
+  Same as load_panel, but the panel is written into shared memory. Returns a SharedPanel
+  """
+  series = _load_series(symbols,start,end,column,mode)
+  if series:
+    dates = np.unique(np.concatenate([item[1] for item in series]))
+  else:
+    dates = np.array([],dtype='datetime64[D]')
+  panel = SharedPanel(dates,[item[0] for item in series])
+  _fill(panel.values(),dates,series)
+  return panel
+
+_SHARED = None
+
+def _attach(panel,func,args,kwargs):
+  """
+  Pool initializer: each worker keeps the shared panel (inherited when the workers are
+  forked) and the analytic, the tasks only carry symbols
+  """
+  global _SHARED
+  _SHARED = (panel,func,args,kwargs)
+
+def _apply(symbol):
+  panel,func,args,kwargs = _SHARED
+  try:
+    return symbol,func(panel.series(symbol),*args,**kwargs),None
+  except Exception as e:
+    return symbol,None,'%s: %s' %(type(e).__name__,e)
+
+def panel_map(func,panel,args=(),kwargs=None,symbols=None,processes=None,chunksize=8):
+  """
+  Run func(series,*args,**kwargs) for every symbol of a SharedPanel over a process pool,
+  series being the yahoo-style dataframe of the symbol (see SharedPanel.series). func must
+  be a module-level function, e.g. panel_map(stock_helper.get_hurst,panel,(100,)) or
+  panel_map(stock_helper.ADF_test,panel,(1,)).
+  Returns (Series of the results indexed by symbol, {symbol - error})
+  """
+  if symbols is None:
+    symbols = panel.symbols
+  results,errors = {},{}
+  pool = multiprocessing.Pool(processes,_attach,(panel,func,args,kwargs or {}))
+  try:
+    for symbol,result,error in pool.imap_unordered(_apply,symbols,chunksize):
+      if error is None:
+        results[symbol] = result
+      else:
+        errors[symbol] = error
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+  done = [symbol for symbol in symbols if symbol in results]
+  return pd.Series([results[symbol] for symbol in done],index=done),errors
@@ -0,0 +1,200 @@
+import collections
+import numpy as np
+
+"""
+Incremental rolling statistics for the moving average, moving standard deviation and
+bollinger bands of stock_class.
+
+A full history is processed once with vectorized running sums (per block of values,
+shifted by the block mean and merged with the pairwise Welford update to limit
+cancellation), then every new bar updates the statistics of each window in constant time
+with a sliding Welford update.
+"""
+
+def _moments(sums,reference):
+  """
+  Count, mean and sum of squared deviations of a part of a window, from its count, sum
+  and sum of squares shifted by reference
+  """
+  count,sum1,sum2 = sums
+  safe = np.maximum(count,1)
+  return count,reference+sum1/safe,sum2-sum1*sum1/safe
+
+def rolling_mean_std(values,window,ddof=1):
+  """
+  Rolling mean and standard deviation over window of a 1-D array, or of every column of
+  a 2-D array (along axis 0), in one vectorized pass. The first window-1 entries are
+  NaN, and so are the windows holding a missing value (same convention as
+  pd.rolling_mean/std).
+  The values are cut in blocks of window rows, each shifted by its own mean. A window
+  covers the end of one block and the start of the next: the statistics of both parts
+  come from running sums within their block, and are merged with the pairwise form of
+  the Welford update. Rounding errors stay of the order of the spread of two blocks
+  instead of growing with the whole history
+  """
+  values = np.asarray(values,dtype=np.float64)
+  mean = np.empty(values.shape)
+  std = np.empty(values.shape)
+  mean.fill(np.nan)
+  std.fill(np.nan)
+  n = len(values)
+  if n < window:
+    return mean,std
+
+  blocks = -(-n//window)
+  padded = np.empty((blocks*window,)+values.shape[1:])
+  padded.fill(np.nan)
+  padded[:n] = values
+  padded = padded.reshape((blocks,window)+values.shape[1:])
+  valid = ~np.isnan(padded)
+  reference = np.where(valid,padded,0.).sum(axis=1)/np.maximum(valid.sum(axis=1),1)
+  shifted = np.where(valid,padded-reference[:,np.newaxis],0.)
+  # running count, sum and sum of squares within each block, one row per value
+  running = [np.cumsum(item,axis=1).reshape((blocks*window,)+values.shape[1:])
+             for item in (valid.astype(np.float64),shifted,shifted*shifted)]
+
+  end = np.arange(window-1,n)
+  start = end-window+1
+  index = (slice(None),)+(np.newaxis,)*(values.ndim-1)
+  aligned = (start%window == 0)[index]
+  # head: from the start of the block of end to end. tail: from start to the end of its
+  # block, empty when the window is exactly one block
+  last = (start//window+1)*window-1
+  before = np.maximum(start-1,0)
+  head = [item[end] for item in running]
+  tail = [np.where(aligned,0.,item[last]-item[before]) for item in running]
+  count_h,mean_h,m2_h = _moments(head,reference[end//window])
+  count_t,mean_t,m2_t = _moments(tail,reference[start//window])
+  total = count_h+count_t
+  delta = np.where((count_h > 0) & (count_t > 0),mean_h-mean_t,0.)
+  full = total == window
+  mean[window-1:] = np.where(full,np.where(count_t > 0,mean_t,mean_h)+delta*count_h/window,np.nan)
+  if window > ddof:
+    m2 = m2_h+m2_t+delta*delta*count_h*count_t/window
+    std[window-1:] = np.where(full,np.sqrt(np.maximum(m2,0)/(window-ddof)),np.nan)
+  return mean,std
+
+class RollingStats:
+  """
+  Running mean and standard deviation of a price series over one or several window
+  lengths at once.
+  fit() processes a history in one vectorized pass, then update() adds a new value in
+  O(1) per window. Every refresh updates, the statistics are recomputed exactly from the
+  values in the window to stop rounding errors from accumulating. Missing values (NaN)
+  are left out of the running state, which holds the last valid values.
+  """
+  def __init__(self,windows,ddof=1,refresh=10000):
+    if isinstance(windows,int):
+      windows = [windows]
+    self._windows = sorted(set(windows))
+    self._ddof = ddof
+    self._refresh = refresh
+    self.reset()
+
+  def reset(self):
+    self._values = collections.deque(maxlen=self._windows[-1])
+    self._mean = dict((window,0.) for window in self._windows)
+    self._m2 = dict((window,0.) for window in self._windows)
+    self._count = 0
+    self._updates = 0
+
+  def windows(self):
+    return self._windows
+
+  def count(self):
+    return self._count
+
+  def _exact(self,window):
+    """
+    Recompute the statistics of window from the stored values
+    """
+    tail = np.array(self._values)[-window:]
+    self._mean[window] = tail.mean() if len(tail) else 0.
+    self._m2[window] = ((tail-self._mean[window])**2).sum()
+
+  def fit(self,values):
+    """
+    Full pass over a history (replaces the current state).
+    Returns a dictionary {window - (rolling mean, rolling std)} of arrays aligned on values
+    """
+    values = np.asarray(values,dtype=np.float64)
+    self.reset()
+    valid = values[~np.isnan(values)]
+    self._values.extend(valid[-self._windows[-1]:].tolist())
+    self._count = len(valid)
+    result = {}
+    for window in self._windows:
+      result[window] = rolling_mean_std(values,window,self._ddof)
+      self._exact(window)
+    return result
+
+  def update(self,value):
+    """
+    Add one value and update every window in constant time (a NaN is skipped)
+    """
+    value = float(value)
+    if np.isnan(value):
+      return
+    for window in self._windows:
+      mean = self._mean[window]
+      if self._count < window:
+        # the window is still filling up: regular Welford step
+        new_mean = mean+(value-mean)/(self._count+1)
+        self._m2[window] += (value-mean)*(value-new_mean)
+      else:
+        # sliding step: value enters the window, the oldest value leaves it
+        old = self._values[-window]
+        new_mean = mean+(value-old)/window
+        self._m2[window] += (value-old)*(value-new_mean+old-mean)
+      self._mean[window] = new_mean
+    self._values.append(value)
+    self._count += 1
+    self._updates += 1
+    if self._refresh and self._updates%self._refresh == 0:
+      for window in self._windows:
+        self._exact(window)
+
+  def mean(self,window):
+    """
+    Current moving average over window (NaN until window values were seen)
+    """
+    if self._count < window:
+      return np.nan
+    return self._mean[window]
+
+  def std(self,window):
+    """
+    Current moving standard deviation over window (NaN until window values were seen)
+    """
+    if self._count < window or window <= self._ddof:
+      return np.nan
+    return np.sqrt(max(self._m2[window],0.)/(window-self._ddof))
+
+class BollingerBands:
+  """
+  Bollinger bands over N_period with the upper and lower bands at K_sigma standard
+  deviations from the moving average, updated in constant time as daily data arrives
+  """
+  def __init__(self,N_period,K_sigma):
+    self._N = N_period
+    self._K = K_sigma
+    self._stats = RollingStats(N_period)
+
+  def fit(self,prices):
+    """
+    Bands over a full history: (moving average, top band, bottom band) arrays
+    """
+    mean,std = self._stats.fit(prices)[self._N]
+    return mean,mean+self._K*std,mean-self._K*std
+
+  def update(self,price):
+    """
+    Add the price of a new bar and return the current (moving average, top, bottom)
+    """
+    self._stats.update(price)
+    return self.bands()
+
+  def bands(self):
+    mean = self._stats.mean(self._N)
+    std = self._stats.std(self._N)
+    return mean,mean+self._K*std,mean-self._K*std
@@ -0,0 +1,283 @@
+import re
+import datetime
+import numpy as np
+import pandas as pd
+import stock_helper
+import stock_database
+
+"""
+Universe screener over precomputed metrics.
+
+The METRICS table of market.db holds, for each symbol, the Sharpe ratio, volatility,
+Hurst exponent, mean reversion half-life, variance ratio and ADF tests over its last
+WINDOW days. The ingest marks a symbol as stale when it writes new prices, and
+refresh_metrics only recomputes the stale symbols (the downloader runs it at the end of
+each download).
+
+screen turns a filter expression into a single SQL query over METRICS joined to SUMMARY.
+Every metric column is indexed, e.g.
+    screen("Sector == 'Technology' and Hurst < 0.5 and Sharpe > 1")
+The expression only accepts the known columns, comparisons (<, <=, >, >=, ==, !=, in,
+like), and, or, not and parentheses. Values are passed as query parameters.
+
+Usage: python stock_screener.py refresh [--all] | screen "Hurst < 0.5 and Sharpe > 1"
+"""
+
+WINDOW = 504                  # days of prices used for the metrics (about two years)
+HURST_LAG = 100
+VR_LAG = 2
+ADF_LAG = 1
+
+SUMMARY_COLUMNS = ['Symbol','Name','Type','Sector','Industry']
+INFO_COLUMNS = ['Stale','Updated','Rows','First','Last']
+
+def _fields():
+  """
+  Columns usable in a filter (lower case name - qualified SQL column)
+  """
+  fields = dict((column.lower(),'s.%s' %column) for column in SUMMARY_COLUMNS)
+  for column in stock_database.METRIC_COLUMNS+INFO_COLUMNS:
+    fields[column.lower()] = 'm.%s' %column
+  return fields
+
+_TOKEN = re.compile(r'''\s*(?:(?P<number>-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)|(?P<string>'[^']*'|"[^"]*")|'''
+                    r'''(?P<operator><=|>=|==|!=|<>|<|>|=)|(?P<punctuation>[(),])|(?P<word>[A-Za-z_][A-Za-z_0-9]*))''')
+_OPERATORS = {'<':'<','<=':'<=','>':'>','>=':'>=','=':'=','==':'=','!=':'!=','<>':'!='}
+
+def _tokenize(expression):
+  tokens = []
+  position = 0
+  expression = expression.rstrip()
+  while position < len(expression):
+    match = _TOKEN.match(expression,position)
+    if match is None or match.end() == position:
+      raise ValueError('unexpected character at position %d of the filter: %s' %(position,expression[position:]))
+    kind = match.lastgroup
+    value = match.group(kind)
+    if kind == 'number':
+      value = float(value)
+    elif kind == 'string':
+      value = value[1:-1]
+    elif kind == 'word':
+      value = value.lower()
+    tokens.append((kind,value))
+    position = match.end()
+  return tokens
+
+class FilterParser:
+  """
+  Recursive descent parser turning a filter expression into a SQL WHERE clause and its
+  parameters. Only known columns and literal values are accepted
+  """
+  def __init__(self,expression):
+    self._tokens = _tokenize(expression)
+    self._position = 0
+    self._fields = _fields()
+    self.params = []
+
+  def _peek(self):
+    if self._position < len(self._tokens):
+      return self._tokens[self._position]
+    return (None,None)
+
+  def _next(self):
+    token = self._peek()
+    if token[0] is None:
+      raise ValueError('unexpected end of the filter')
+    self._position += 1
+    return token
+
+  def _expect(self,value):
+    kind,token = self._next()
+    if token != value:
+      raise ValueError('expected %s in the filter, got %s' %(value,token))
+
+  def parse(self):
+    sql = self._or()
+    if self._peek()[0] is not None:
+      raise ValueError('unexpected %s in the filter' %(self._peek()[1],))
+    return sql
+
+  def _or(self):
+    terms = [self._and()]
+    while self._peek() == ('word','or'):
+      self._next()
+      terms.append(self._and())
+    return terms[0] if len(terms) == 1 else '(%s)' %' OR '.join(terms)
+
+  def _and(self):
+    terms = [self._not()]
+    while self._peek() == ('word','and'):
+      self._next()
+      terms.append(self._not())
+    return terms[0] if len(terms) == 1 else '(%s)' %' AND '.join(terms)
+
+  def _not(self):
+    if self._peek() == ('word','not'):
+      self._next()
+      return 'NOT %s' %self._not()
+    if self._peek() == ('punctuation','('):
+      self._next()
+      sql = self._or()
+      self._expect(')')
+      return sql
+    return self._comparison()
+
+  def _value(self):
+    kind,value = self._next()
+    if kind not in ('number','string'):
+      raise ValueError('expected a number or a quoted string in the filter, got %s' %(value,))
+    self.params.append(value)
+    return '?'
+
+  def _comparison(self):
+    kind,name = self._next()
+    if kind != 'word' or name not in self._fields:
+      raise ValueError('unknown column %s in the filter, use one of %s' %(name,', '.join(sorted(self._fields))))
+    column = self._fields[name]
+    kind,operator = self._next()
+    if kind == 'operator':
+      return '%s %s %s' %(column,_OPERATORS[operator],self._value())
+    if (kind,operator) == ('word','like'):
+      return '%s LIKE %s' %(column,self._value())
+    if (kind,operator) == ('word','in'):
+      self._expect('(')
+      values = [self._value()]
+      while self._peek() == ('punctuation',','):
+        self._next()
+        values.append(self._value())
+      self._expect(')')
+      return '%s IN (%s)' %(column,','.join(values))
+    raise ValueError('expected a comparison after %s in the filter, got %s' %(name,operator))
+
+def to_sql(expression):
+  """
+  WHERE clause and parameters of a filter expression
+  """
+  parser = FilterParser(expression)
+  return parser.parse(),parser.params
+
+def screen(expression=None,order_by='Sharpe',ascending=False,limit=None,stale=True):
+  """
+  Symbols of SUMMARY whose metrics match the filter expression, in one query.
+
+  Parameters:
+      - expression : filter, e.g. "Sector == 'Technology' and Hurst < 0.5 and Sharpe > 1"
+                     (default: every symbol with metrics)
+      - order_by, ascending : sort column
+      - limit : maximum number of symbols returned
+      - stale : if False, symbols whose metrics are stale are left out
+
+  Returns a dataframe with the summary and the metrics of the matching symbols
+  """
+  fields = _fields()
+  if order_by.lower() not in fields:
+    raise ValueError('unknown column %s' %order_by)
+  where,params = to_sql(expression) if expression else ('1',[])
+  if not stale:
+    where = '(%s) AND m.Stale=0' %where
+  columns = ['s.%s' %column for column in SUMMARY_COLUMNS]+['m.%s' %column for column in stock_database.METRIC_COLUMNS+INFO_COLUMNS]
+  query = 'SELECT %s FROM %s m JOIN SUMMARY s ON s.Symbol=m.Symbol WHERE %s ORDER BY %s %s' %(','.join(columns),
+          stock_database.METRICS_TABLE,where,fields[order_by.lower()],'ASC' if ascending else 'DESC')
+  if limit is not None:
+    query += ' LIMIT ?'
+    params = params+[int(limit)]
+  db,cur = stock_database.connection()
+  stock_database.create_metrics_table(cur)
+  cur.execute(query,params)
+  return pd.DataFrame(cur.fetchall(),columns=SUMMARY_COLUMNS+stock_database.METRIC_COLUMNS+INFO_COLUMNS)
+
+def _finite(value):
+  """
+  float(value), or None for a missing or infinite value
+  """
+  if value is None:
+    return None
+  value = float(value)
+  return value if np.isfinite(value) else None
+
+def compute_metrics(symbol,days=WINDOW):
+  """
+  Metrics of the last days prices of symbol, as a dictionary {column - value}. A test
+  failing on the data gives None. Returns None if the symbol has no prices
+  """
+  data = stock_database.extract_series(symbol,columns=['Adj Close'],as_arrays=True)
+  if data is None or not len(data['date']):
+    return None
+  dates = data['date'][-days:]
+  prices = data['Adj Close'][-days:]
+  series = pd.DataFrame({'Adj Close':prices},index=pd.DatetimeIndex(dates))
+  metrics = {'Rows':len(prices),'First':str(dates[0]),'Last':str(dates[-1])}
+
+  tests = [(['Sharpe'],lambda: [stock_helper.sharpe_ratio(prices)]),
+           (['Volatility'],lambda: [np.nanstd(stock_helper.daily_returns(prices))*np.sqrt(252)]),
+           (['Hurst'],lambda: [stock_helper.get_hurst(series,HURST_LAG)]),
+           (['Half_life'],lambda: [stock_helper.mean_reversion_half_life(series)]),
+           (['VR_stat','VR_pvalue'],lambda: stock_helper.variance_ratio_test(series,VR_LAG)),
+           (['ADF_stat','ADF_pvalue'],lambda: stock_helper.ADF_test(series,ADF_LAG)[:2])]
+  for names,test in tests:
+    try:
+      values = test()
+    except Exception:
+      values = [None]*len(names)
+    for name,value in zip(names,values):
+      metrics[name] = _finite(value)
+  return metrics
+
+def refresh_metrics(symbols=None,stale_only=True,commit_every=100):
+  """
+  Recompute the metrics of symbols. Default: the stale symbols of the METRICS table, or
+  every symbol of the database with stale_only=False (first build).
+  A symbol written again during its refresh stays stale.
+  Returns the number of symbols refreshed
+  """
+  db,cur = stock_database.connection()
+  stock_database.create_metrics_table(cur)
+  db.commit()
+  table = stock_database.METRICS_TABLE
+  if symbols is None:
+    if stale_only:
+      cur.execute('SELECT Symbol FROM %s WHERE Stale=1' %table)
+      symbols = [symbol for (symbol,) in cur.fetchall()]
+    else:
+      symbols = sorted(stock_database.latest_dates())
+  columns = ['Rows','First','Last']+stock_database.METRIC_COLUMNS
+  statement = 'UPDATE %s SET Updated=?, %s, Stale=CASE WHEN Version=? THEN 0 ELSE 1 END WHERE Symbol=?' %(table,
+              ', '.join('%s=?' %column for column in columns))
+
+  refreshed = 0
+  for symbol in symbols:
+    cur.execute('INSERT OR IGNORE INTO %s(Symbol) VALUES(?)' %table,(symbol,))
+    cur.execute('SELECT Version FROM %s WHERE Symbol=?' %table,(symbol,))
+    version = cur.fetchone()[0]
+    db.commit()
+    metrics = compute_metrics(symbol)
+    if metrics is None:
+      continue
+    cur.execute(statement,[datetime.datetime.now().isoformat()]+[metrics[column] for column in columns]+[version,symbol])
+    refreshed += 1
+    if refreshed%commit_every == 0:
+      db.commit()
+  db.commit()
+  return refreshed
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description='metrics table and universe screener')
+  parser.add_argument('--db',default=stock_database.DB_PATH,help='path of the sqlite database')
+  commands = parser.add_subparsers(dest='command')
+  refresh = commands.add_parser('refresh',help='recompute the stale metrics')
+  refresh.add_argument('symbols',nargs='*')
+  refresh.add_argument('--all',action='store_true',help='every symbol of the database, stale or not')
+  query = commands.add_parser('screen',help='symbols matching a filter expression')
+  query.add_argument('expression',nargs='?')
+  query.add_argument('--order-by',default='Sharpe')
+  query.add_argument('--ascending',action='store_true')
+  query.add_argument('--limit',type=int)
+  args = parser.parse_args()
+
+  stock_database.configure(args.db)
+  if args.command == 'refresh':
+    print '%d symbols refreshed' %refresh_metrics(args.symbols or None,not args.all)
+  else:
+    print screen(args.expression,args.order_by,args.ascending,args.limit).to_string()
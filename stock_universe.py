@@ -0,0 +1,136 @@
+import datetime
+import pandas as pd
+import stock_helper
+import stock_panel
+import stock_class
+
+"""
+Container for many symbols over one shared date axis.
+
+Columns ("Adj Close", "Volume"...) are loaded for all the symbols at once, and only when
+first accessed, into date-aligned panels. Per-symbol views expose the methods of the
+stock class on top of these panels without loading or validating anything per symbol.
+Bad input raises exceptions (ValueError, KeyError) instead of exiting.
+"""
+
+class StockUniverse:
+  """
+  Many symbols between start and end, with lazily loaded columns
+
+  Parameters:
+      - symbols : list of ticker symbols
+      - start, end : datetime.date or dd/mm/yyyy strings, optional (default: whole history)
+      - mode : "disk" (sqlite database) or "columnar" (memory-mapped columnar store)
+      - columns : columns of the historical data of the per-symbol views (default: all).
+                  e.g. ['Adj Close'] if the views are only used for Sharpe ratios
+  """
+  def __init__(self,symbols,start=None,end=None,mode='disk',columns=None):
+    symbols = list(symbols)
+    if not symbols:
+      raise ValueError('the universe needs at least one symbol')
+    if len(set(symbols)) != len(symbols):
+      raise ValueError('duplicated symbols in the universe')
+    if mode not in ('disk','columnar'):
+      raise ValueError('unknown mode %s, use "disk" or "columnar"' %mode)
+    self._symbols = symbols
+    self._positions = dict((symbol,i) for i,symbol in enumerate(symbols))
+    self._start = self._check_date(start)
+    self._end = self._check_date(end)
+    if self._start is not None and self._end is not None and self._start > self._end:
+      raise ValueError('The start date must be prior to the end date')
+    self._mode = mode
+    self._view_columns = columns or ['Open','High','Low','Close','Volume','Adj Close']
+    self._columns = {}
+    self._dates = None
+
+  def _check_date(self,date):
+    if date is None or isinstance(date,datetime.date):
+      return date
+    date,check = stock_helper.check_date_format(date)
+    if check == 'fail':
+      raise ValueError('please use the correct format for the date, dd/mm/yyyy')
+    return date
+
+  def __repr__(self):
+    return 'StockUniverse(%d symbols, from %s to %s, %s mode, loaded: %s)' %(len(self._symbols),
+           self._start,self._end,self._mode,', '.join(sorted(self._columns)) or 'nothing')
+
+  def __len__(self):
+    return len(self._symbols)
+
+  def __contains__(self,symbol):
+    return symbol in self._positions
+
+  def __iter__(self):
+    for symbol in self._symbols:
+      yield self.view(symbol)
+
+  def __getitem__(self,symbol):
+    return self.view(symbol)
+
+  def symbols(self):
+    return self._symbols
+
+  def dates(self):
+    """
+    Shared date axis (union of the dates of all the symbols)
+    """
+    if self._dates is None:
+      self.column('Adj Close')
+    return self._dates
+
+  def column(self,column):
+    """
+    Date-aligned panel of column for all the symbols (dates x symbols), loaded on first
+    access. Symbols without data are columns of NaN
+    """
+    if column not in self._columns:
+      panel = stock_panel.load_panel(self._symbols,self._start,self._end,column,self._mode)
+      if self._dates is None:
+        self._dates = panel.index
+      self._columns[column] = panel.reindex(index=self._dates,columns=self._symbols)
+    return self._columns[column]
+
+  def historical(self,symbol,columns=None):
+    """
+    Historical dataframe of symbol (yahoo finance format), built from the shared panels
+    """
+    if symbol not in self._positions:
+      raise KeyError(symbol)
+    if columns is None:
+      columns = self._view_columns
+    data = pd.DataFrame(dict((column,self.column(column)[symbol]) for column in columns),
+                        index=self.dates(),columns=columns)
+    return data.dropna(how='all')
+
+  def view(self,symbol):
+    """
+    Lightweight stock object for symbol, sharing the data of the universe
+    """
+    if symbol not in self._positions:
+      raise KeyError(symbol)
+    return StockView(self,symbol)
+
+class StockView(stock_class.stock):
+  """
+  Per-symbol view of a StockUniverse with the API of the stock class. Nothing is loaded
+  until the historical data is first used
+  """
+  def __init__(self,universe,symbol):
+    self._universe = universe
+    self._symbol = symbol
+    self._name = stock_class.SYMBOL_DIC.get(symbol,('unknown',))[0]
+    self._start = universe._start
+    self._end = universe._end
+    self._mode = universe._mode
+    self._interactive = False
+
+  def __getattr__(self,attribute):
+    if attribute == '_historical':
+      self._historical = self._universe.historical(self._symbol)
+      return self._historical
+    raise AttributeError(attribute)
+
+  def get_historical(self):
+    self._historical = self._universe.historical(self._symbol)
+    return self._historical